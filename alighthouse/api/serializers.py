@@ -1,12 +1,14 @@
 from rest_framework import serializers
 
+from core.helpers import validate_country_codes
+
 
 class DomainLighthouseSerializer(serializers.Serializer):
     domains = serializers.CharField(max_length=4096)
     key = serializers.CharField(max_length=2048)
     secret = serializers.CharField(max_length=2048)
     amount = serializers.IntegerField()
-    country_code = serializers.CharField(max_length=3)
+    country_code = serializers.CharField(max_length=256, validators=[validate_country_codes])
     file = serializers.FileField()
 
 
@@ -23,8 +23,9 @@ from pptx.util import Pt
 from pptx.dml.color import RGBColor
 from urllib.parse import urlparse
 
+from core.batch import run_batch
 from core.helpers import (generate_random_number, generate_directories, get_keyword_volume, get_subdomain, average,
-                          get_access_token, log_to_telegram_bot, send_mail)
+                          get_access_token, log_to_telegram_bot, send_mail, parse_country_codes)
 from core.searchmetrics import SearchmetricsAPI
 from .models import *
 
@@ -105,53 +106,86 @@ def lighthouse_report(url):
     return serializer
 
 
-@background(schedule=1)
-def run_domain_lighthouse(key, secret, amount, country_code, domain, uploaded_file_url=None):
-    api = SearchmetricsAPI(key, secret)
+def get_domain_rankings(api, domain, amount, country_code, concurrency=None):
+    """
+    Returns DataFrame of the keywords the domain ranks for in a single country with their ranking URLs
+    """
+    keywords = []
+    for element in api.iter_rankings_domain(
+            domain=domain,
+            amount=amount,
+            country_code=country_code,
+            concurrency=concurrency
+    ):
+        keywords.append(element['keyword'])
+
+    results = run_batch(
+        lambda keyword: api.get_list_rankings_keyword(
+            keyword=keyword,
+            country_code=country_code
+        ),
+        keywords,
+        concurrency=concurrency
+    )
 
-    if not uploaded_file_url:
-        keyword_info = {}
-        keywords = []
-        offset = 0
-        for _ in range(amount // 250):
-            status, response = api.get_rankings_domain(
-                domain=domain,
-                country_code=country_code,
-                offset=offset
-            )
+    ranking = []
+    keywords_list, position, urls = [], [], []
+    for keyword, result in zip(keywords, results):
+        if not result.ok:
+            continue
 
-            for element in response:
-                keywords.append(element['keyword'])
-                keyword_info[element['keyword']] = element
+        status, ranking_info = result.value
+        if not status:
+            continue
 
-            offset += 250
+        if len(ranking_info) == 0:
+            ranking.append(keyword)
 
-        ranking = []
-        keywords_list, position, urls = [], [], []
-        for index, keyword in enumerate(keywords):
-            status, ranking_info = api.get_list_rankings_keyword(
-                keyword=keyword,
-                country_code=country_code
-            )
+        for info in ranking_info:
+            keywords_list.append(keyword)
+            position.append(info['position'])
+            urls.append(info['url'])
 
-            if not status:
-                continue
+    return pd.DataFrame(
+        {
+            'Keyword': keywords_list,
+            'URL': urls,
+            'Position': position,
+        }
+    )
 
-            if len(ranking_info) == 0:
-                ranking.append(keyword)
 
-            for info in ranking_info:
-                keywords_list.append(keyword)
-                position.append(info['position'])
-                urls.append(info['url'])
+@background(schedule=1)
+def run_domain_lighthouse(key, secret, amount, country_code, domain, uploaded_file_url=None, concurrency=None):
+    api = SearchmetricsAPI(key, secret)
+    countries = parse_country_codes(country_code)
+    country_counts = None
 
-        df = pd.DataFrame(
-            {
-                'Keyword': keywords_list,
-                'URL': urls,
-                'Position': position,
-            }
+    if not uploaded_file_url:
+        results = run_batch(
+            lambda cc: get_domain_rankings(api, domain, amount, cc, concurrency),
+            countries,
+            concurrency=len(countries)
         )
+
+        frames = []
+        for result in results:
+            if not result.ok:
+                logger.info(f"Searchmetrics rankings of {result.item} failed: {result.error}")
+                continue
+            frames.append(result.value.assign(Country=result.item))
+
+        if frames:
+            df = pd.concat(frames, ignore_index=True)
+        else:
+            df = pd.DataFrame(columns=['Keyword', 'URL', 'Position', 'Country'])
+        if len(countries) > 1:
+            country_counts = df['Country'].value_counts(sort=False).to_dict()
+            # Lighthouse results do not depend on the market, run every ranking URL once
+            df = df.drop_duplicates(subset=['Keyword', 'URL'], ignore_index=True)
+        else:
+            df = df.drop(columns='Country', errors='ignore')
+        keywords_list = df['Keyword']
     else:
         df = pd.read_excel(f'/{uploaded_file_url}')
         keywords_list = df['Keyword']
@@ -162,10 +196,10 @@ def run_domain_lighthouse(key, secret, amount, country_code, domain, uploaded_fi
                                        f'Country code: {country_code}\nAmount: {amount}')
         return
 
-    run_lighthouse_report(df, domain, amount)
+    run_lighthouse_report(df, domain, amount, country_counts=country_counts)
 
 
-def run_lighthouse_report(df, domain, amount):
+def run_lighthouse_report(df, domain, amount, country_counts=None):
     failed, completed, already_exists = [], [], []
     for url, keyword, position in zip(df["URL"], df["Keyword"], df["Position"]):
         url = f"https://{url}"
@@ -304,6 +338,9 @@ def run_lighthouse_report(df, domain, amount):
     failed.to_excel(writer, sheet_name='failed', index=False)
     completed = pd.DataFrame({'Keyword': completed})
     completed.to_excel(writer, sheet_name='completed', index=False)
+    if country_counts:
+        countries = pd.DataFrame({'Country': list(country_counts), 'Rankings': list(country_counts.values())})
+        countries.to_excel(writer, sheet_name='countries', index=False)
     writer.save()
 
     send_mail('Lighthouse Run', f'Lighthouse Run for domain {domain} is completed. ', output)
@@ -0,0 +1,18 @@
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework.status import HTTP_200_OK, HTTP_204_NO_CONTENT
+
+from core.metrics import get_metrics
+
+
+class APIMetricsAPI(APIView):
+    """
+    API Class for getting per-endpoint metrics of the Searchmetrics API calls of all workers:
+    call counts, cache hits, latency (average, p50, p95, max, total), bytes, retries and errors
+    """
+    def get(self, request, *args, **kwargs):
+        metrics = get_metrics()
+        if metrics is None:
+            return Response(status=HTTP_204_NO_CONTENT)
+
+        return Response(metrics.summary(), status=HTTP_200_OK)
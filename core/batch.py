@@ -0,0 +1,115 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger('django')
+
+DEFAULT_CONCURRENCY = 8
+PAGE_SIZE = 250
+
+
+class BatchResult:
+    """
+    Outcome of a single item of the batch
+
+    Attributes:
+        item: input item the function was called with
+        value: returned value, None if the call raised
+        error (Exception): raised exception, None if the call succeeded
+    """
+    __slots__ = ('item', 'value', 'error')
+
+    def __init__(self, item, value=None, error=None):
+        self.item = item
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def get_concurrency(concurrency=None):
+    if concurrency is None:
+        concurrency = getattr(settings, 'SEARCH_METRICS_CONCURRENCY', DEFAULT_CONCURRENCY)
+    return max(int(concurrency), 1)
+
+
+def _call(func, item):
+    try:
+        return BatchResult(item, value=func(item))
+    except Exception as err:
+        logger.info(f"Batch: Error occurred while processing {item}: {err}")
+        return BatchResult(item, error=err)
+
+
+def run_batch(func, items, concurrency=None):
+    """
+    Calls func for every item with bounded concurrency.
+
+    Args:
+        func (callable): function of a single item, usually one API lookup
+        items (iterable): items to process, e.g. keywords
+        concurrency (int): maximum number of parallel calls, SEARCH_METRICS_CONCURRENCY by default
+
+    Returns:
+        list of BatchResult in the order of the input items
+    """
+    items = list(items)
+    concurrency = get_concurrency(concurrency)
+
+    if concurrency == 1 or len(items) <= 1:
+        return [_call(func, item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(items))) as executor:
+        return list(executor.map(lambda item: _call(func, item), items))
+
+
+def iter_pages(fetch_page, amount, page_size=PAGE_SIZE, concurrency=None):
+    """
+    Fetches pages of a paginated endpoint concurrently and yields them in offset order
+    as soon as they arrive. Stops after the first short or empty page, which marks the
+    end of the data, without requesting further offsets.
+
+    Args:
+        fetch_page (callable): function of the offset returning (status, rows)
+        amount (int): maximum amount of rows, only full pages are requested
+        page_size (int): rows per page
+        concurrency (int): maximum number of pages requested in parallel
+
+    Yields:
+        (status, rows) of every requested page
+    """
+    max_pages = int(amount) // page_size
+    if max_pages <= 0:
+        return
+
+    workers = min(get_concurrency(concurrency), max_pages)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    next_page = 0
+
+    def submit():
+        nonlocal next_page
+        pending.append(executor.submit(fetch_page, next_page * page_size))
+        next_page += 1
+
+    try:
+        while next_page < max_pages and len(pending) < workers:
+            submit()
+
+        while pending:
+            status, rows = pending.popleft().result()
+            yield status, rows
+
+            if status and (not rows or len(rows) < page_size):
+                break
+
+            if next_page < max_pages:
+                submit()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from time import time
+
+from django.conf import settings
+
+logger = logging.getLogger('django')
+
+DEFAULT_MAX_ENTRIES = 500000
+DEFAULT_TTL = 24 * 3600
+
+DEFAULT_TTLS = {
+    'v3/ResearchKeywordsGetListKeywordinfo': 7 * 24 * 3600,
+    'v4/ResearchKeywordsGetListKeywordinfo': 7 * 24 * 3600,
+    'v4/ResearchKeywordsGetListSimilarKeywords': 7 * 24 * 3600,
+    'v4/ResearchOrganicGetListRankingsKeyword': 24 * 3600,
+    'v3/ResearchOrganicGetListRankingsDomain': 24 * 3600,
+    'v4/ResearchOrganicGetListRankingsDomain': 24 * 3600,
+    'v3/ResearchOrganicGetListRankingsDomainHistoric': 30 * 24 * 3600,
+    'v4/ResearchOrganicGetListRankingsDomainHistoric': 30 * 24 * 3600,
+    'GraphQLUserIntent': 30 * 24 * 3600,
+}
+
+EVICTION_INTERVAL = 1000
+
+
+class CachedResponse:
+    """
+    Stored API response exposing the parts of requests.Response used by the callers
+    """
+    def __init__(self, status_code, content, url=None):
+        self.status_code = status_code
+        self.content = content
+        self.url = url
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self, **kwargs):
+        kwargs.pop('encoding', None)
+        return json.loads(self.text, **kwargs)
+
+
+def normalize_params(params):
+    normalized = {}
+    for key, value in params.items():
+        if key == 'access_token':
+            continue
+        if key in ('keyword', 'countrycode', 'url'):
+            value = str(value).lower().strip()
+        normalized[key] = str(value)
+    return normalized
+
+
+class ResponseCache:
+    """
+    On-disk cache of Searchmetrics responses stored in SQLite, shared by all worker processes
+
+    Attributes:
+        path (str): path of the SQLite database
+        ttls (dict): time to live in seconds per versioned endpoint, endpoints without TTL are not cached
+        max_entries (int): amount of entries kept, least recently used ones are evicted
+    """
+    def __init__(self, path, ttls=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        self._writes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, endpoint TEXT, status_code INTEGER, content BLOB, '
+                'expires_at REAL, accessed_at REAL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def is_cached_endpoint(self, endpoint):
+        return self.ttls.get(endpoint) is not None
+
+    @staticmethod
+    def make_key(endpoint, params):
+        return endpoint + ':' + json.dumps(normalize_params(params), sort_keys=True)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, endpoint, params):
+        key = self.make_key(endpoint, params)
+        now = time()
+
+        try:
+            with self._connection() as connection:
+                row = connection.execute(
+                    'SELECT status_code, content, expires_at FROM responses WHERE key = ?', (key,)
+                ).fetchone()
+
+                if row is None or row[2] < now:
+                    self._count(hit=False)
+                    return None
+
+                connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+        except sqlite3.Error as err:
+            logger.info(f"Cache: Could not read cached response for {key}: {err}")
+            self._count(hit=False)
+            return None
+
+        self._count(hit=True)
+        return CachedResponse(row[0], bytes(row[1]))
+
+    def contains(self, endpoint, params):
+        """
+        Checks for a fresh entry without counting it as a hit or refreshing it
+        """
+        try:
+            with self._connection() as connection:
+                row = connection.execute(
+                    'SELECT expires_at FROM responses WHERE key = ?', (self.make_key(endpoint, params),)
+                ).fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None and row[0] >= time()
+
+    def set(self, endpoint, params, status_code, content):
+        ttl = self.ttls.get(endpoint, DEFAULT_TTL)
+        key = self.make_key(endpoint, params)
+        now = time()
+
+        try:
+            with self._connection() as connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO responses (key, endpoint, status_code, content, expires_at, accessed_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, endpoint, status_code, sqlite3.Binary(content), now + ttl, now)
+                )
+        except sqlite3.Error as err:
+            logger.info(f"Cache: Could not store response for {key}: {err}")
+            return
+
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        try:
+            with self._connection() as connection:
+                connection.execute('DELETE FROM responses WHERE expires_at < ?', (time(),))
+                entries = connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+                if entries > self.max_entries:
+                    connection.execute(
+                        'DELETE FROM responses WHERE key IN '
+                        '(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)',
+                        (entries - int(self.max_entries * 0.9),)
+                    )
+        except sqlite3.Error as err:
+            logger.info(f"Cache: Could not evict responses: {err}")
+
+    def clear(self, endpoint=None):
+        with self._connection() as connection:
+            if endpoint:
+                connection.execute('DELETE FROM responses WHERE endpoint = ?', (endpoint,))
+            else:
+                connection.execute('DELETE FROM responses')
+
+    def stats(self):
+        with self._connection() as connection:
+            entries = dict(connection.execute('SELECT endpoint, COUNT(*) FROM responses GROUP BY endpoint'))
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns process-wide response cache or None if it is disabled with SEARCH_METRICS_CACHE_ENABLED
+    """
+    global _cache
+
+    if not getattr(settings, 'SEARCH_METRICS_CACHE_ENABLED', True):
+        return None
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                default_path = os.path.join(getattr(settings, 'BASE_DIR', tempfile.gettempdir()),
+                                            'searchmetrics_cache.sqlite3')
+                _cache = ResponseCache(
+                    path=str(getattr(settings, 'SEARCH_METRICS_CACHE_PATH', default_path)),
+                    ttls={**DEFAULT_TTLS, **getattr(settings, 'SEARCH_METRICS_CACHE_TTLS', {})},
+                    max_entries=getattr(settings, 'SEARCH_METRICS_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+                )
+    return _cache
@@ -0,0 +1,129 @@
+import logging
+import threading
+from time import monotonic
+
+from django.conf import settings
+
+logger = logging.getLogger('django')
+
+DEFAULT_FAILURE_THRESHOLD = 10
+DEFAULT_COOLDOWN = 30
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an endpoint whose circuit is open
+    """
+    def __init__(self, endpoint, retry_in):
+        super().__init__(f"Circuit of {endpoint} is open, retry in {retry_in:.0f}s")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class _Circuit:
+    __slots__ = ('state', 'failures', 'opened_at')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+
+
+class CircuitBreaker:
+    """
+    Per-endpoint circuit breaker. After failure_threshold consecutive failures calls of
+    the endpoint fail fast with CircuitOpenError for cooldown seconds. Then a single probe
+    call is let through: its success closes the circuit, its failure opens it again.
+
+    Attributes:
+        failure_threshold (int): consecutive failures opening the circuit
+        cooldown (float): seconds the circuit stays open before probing
+    """
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, cooldown=DEFAULT_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def _circuit(self, endpoint):
+        circuit = self._circuits.get(endpoint)
+        if circuit is None:
+            circuit = self._circuits[endpoint] = _Circuit()
+        return circuit
+
+    def state(self, endpoint):
+        with self._lock:
+            return self._circuit(endpoint).state
+
+    def before_call(self, endpoint):
+        """
+        Raises CircuitOpenError if the endpoint must not be called now
+        """
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit.state == CLOSED:
+                return
+
+            retry_in = circuit.opened_at + self.cooldown - monotonic()
+            if circuit.state == OPEN and retry_in <= 0:
+                circuit.state = HALF_OPEN
+                logger.info(f"Circuit: Probing {endpoint}")
+                return
+
+        raise CircuitOpenError(endpoint, max(retry_in, 0))
+
+    def record_success(self, endpoint):
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit.state != CLOSED:
+                logger.info(f"Circuit: {endpoint} recovered, closing circuit")
+            circuit.state = CLOSED
+            circuit.failures = 0
+
+    def release(self, endpoint):
+        """
+        Ends a call that neither succeeded nor failed, the failures are kept
+        and a probe lets the next call probe again
+        """
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit.state == HALF_OPEN:
+                circuit.state = OPEN
+
+    def record_failure(self, endpoint):
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            circuit.failures += 1
+            if circuit.state == HALF_OPEN or circuit.failures >= self.failure_threshold:
+                if circuit.state != OPEN:
+                    logger.info(f"Circuit: {endpoint} failed {circuit.failures} times, "
+                                f"failing fast for {self.cooldown}s")
+                circuit.state = OPEN
+                circuit.opened_at = monotonic()
+
+
+_breaker = None
+_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    """
+    Returns process-wide circuit breaker or None if SEARCH_METRICS_CIRCUIT_FAILURES is 0
+    """
+    global _breaker
+
+    failure_threshold = getattr(settings, 'SEARCH_METRICS_CIRCUIT_FAILURES', DEFAULT_FAILURE_THRESHOLD)
+    if not failure_threshold:
+        return None
+
+    if _breaker is None:
+        with _breaker_lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker(
+                    failure_threshold=failure_threshold,
+                    cooldown=getattr(settings, 'SEARCH_METRICS_CIRCUIT_COOLDOWN', DEFAULT_COOLDOWN)
+                )
+    return _breaker
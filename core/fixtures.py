@@ -0,0 +1,55 @@
+from hashlib import sha1
+import json
+import logging
+import os
+
+from django.conf import settings
+
+from .cache import normalize_params
+
+logger = logging.getLogger('django')
+
+
+def fixture_path(directory, endpoint, params):
+    """
+    Returns path of the fixture, endpoint is the versioned name of transport.endpoint_name,
+    so e.g. v3 and v4 responses of the same method are kept apart
+    """
+    key = json.dumps(normalize_params(params), sort_keys=True)
+    return os.path.join(directory, *endpoint.split('/'), sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def save_fixture(directory, endpoint, params, status_code, content):
+    path = fixture_path(directory, endpoint, params)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'endpoint': endpoint, 'params': normalize_params(params),
+                   'status_code': status_code, 'body': content.decode('utf-8')}, f)
+
+
+def load_fixture(directory, endpoint, params):
+    """
+    Returns (status_code, body) of the recorded response or None if it was not recorded
+    """
+    try:
+        with open(fixture_path(directory, endpoint, params), 'r', encoding='utf-8') as f:
+            fixture = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    return fixture['status_code'], fixture['body'].encode('utf-8')
+
+
+def record(endpoint, params, response):
+    """
+    Stores the response as a fixture of the stand-in server if SEARCH_METRICS_RECORD_DIR is set
+    """
+    directory = getattr(settings, 'SEARCH_METRICS_RECORD_DIR', None)
+    if not directory:
+        return
+
+    try:
+        save_fixture(directory, endpoint, params, response.status_code, response.content)
+    except (OSError, UnicodeDecodeError) as err:
+        logger.info(f"Fixtures: Could not record response of {endpoint}: {err}")
@@ -0,0 +1,139 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+import threading
+from time import monotonic
+
+from django.conf import settings
+
+from . import metrics, ratelimit, transport
+
+logger = logging.getLogger('django')
+
+DEFAULT_HEDGE_PERCENTILE = 95
+DEFAULT_HEDGE_MIN_DELAY = 0.1
+DEFAULT_HEDGE_MIN_SAMPLES = 20
+DEFAULT_HEDGE_WORKERS = 64
+SAMPLES = 200
+
+
+class LatencyTracker:
+    """
+    Latencies of the recent calls per endpoint used to pick the hedging delay
+
+    Attributes:
+        percentile (int): percentile of the recent latencies after which the call is hedged
+        min_delay (float): lower bound of the delay in seconds
+        min_samples (int): calls of the endpoint needed before it is hedged
+    """
+    def __init__(self, percentile=DEFAULT_HEDGE_PERCENTILE, min_delay=DEFAULT_HEDGE_MIN_DELAY,
+                 min_samples=DEFAULT_HEDGE_MIN_SAMPLES):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, latency):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=SAMPLES)
+            samples.append(latency)
+
+    def hedge_delay(self, endpoint):
+        """
+        Returns seconds to wait before the duplicate request, None if there are too few samples
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+
+        if len(samples) < self.min_samples:
+            return None
+
+        index = min(int(len(samples) * self.percentile / 100), len(samples) - 1)
+        return max(samples[index], self.min_delay)
+
+
+class HedgedClient:
+    """
+    Sends GET requests through a worker pool and duplicates a request that did not answer
+    within the recent p95 latency of its endpoint. The first successful response wins,
+    the slower one is left to finish in the background.
+
+    Attributes:
+        tracker (LatencyTracker): recent latencies per endpoint
+        workers (int): size of the pool running the requests
+    """
+    def __init__(self, tracker, workers=DEFAULT_HEDGE_WORKERS):
+        self.tracker = tracker
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hedge')
+
+    def _timed_request(self, endpoint, method, url, **kwargs):
+        started = monotonic()
+        response = transport.request(method, url, **kwargs)
+        self.tracker.add(endpoint, monotonic() - started)
+        return response
+
+    def request(self, endpoint, method, url, **kwargs):
+        delay = self.tracker.hedge_delay(endpoint)
+        if delay is None:
+            return self._timed_request(endpoint, method, url, **kwargs)
+
+        primary = self.executor.submit(self._timed_request, endpoint, method, url, **kwargs)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        ratelimit.acquire(endpoint)
+        metrics.record_retry(endpoint, 'hedge')
+        if kwargs.get('params') is not None:
+            kwargs['params'] = dict(kwargs['params'])
+        hedge = self.executor.submit(self._timed_request, endpoint, method, url, **kwargs)
+
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded:
+                return succeeded[0].result()
+            if not pending:
+                return done.pop().result()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_hedged_client():
+    """
+    Returns process-wide hedged client or None if hedging is disabled with SEARCH_METRICS_HEDGE
+    """
+    global _client
+
+    if not getattr(settings, 'SEARCH_METRICS_HEDGE', False):
+        return None
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                tracker = LatencyTracker(
+                    percentile=getattr(settings, 'SEARCH_METRICS_HEDGE_PERCENTILE', DEFAULT_HEDGE_PERCENTILE),
+                    min_delay=getattr(settings, 'SEARCH_METRICS_HEDGE_MIN_DELAY', DEFAULT_HEDGE_MIN_DELAY),
+                    min_samples=getattr(settings, 'SEARCH_METRICS_HEDGE_MIN_SAMPLES', DEFAULT_HEDGE_MIN_SAMPLES)
+                )
+                _client = HedgedClient(
+                    tracker, workers=getattr(settings, 'SEARCH_METRICS_HEDGE_WORKERS', DEFAULT_HEDGE_WORKERS)
+                )
+    return _client
+
+
+def request(endpoint, method, url, **kwargs):
+    """
+    Sends idempotent GET requests hedged when enabled, other requests directly
+    """
+    client = get_hedged_client() if method == 'GET' else None
+    if client is None:
+        return transport.request(method, url, **kwargs)
+    return client.request(endpoint, method, url, **kwargs)
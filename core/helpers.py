@@ -1,10 +1,11 @@
-import base64
+import json
 from json import JSONDecodeError
 import logging
 import random
 import re
 import requests
 
+from django.core.exceptions import ValidationError
 from django.core.mail import EmailMessage
 from django.core.files.storage import FileSystemStorage
 from django.conf import settings
@@ -12,6 +13,14 @@ from django.conf import settings
 import urllib.parse as urlparse
 import numpy as np
 
+from . import ratelimit, transport
+from .cache import get_cache
+from .fixtures import record
+from .matcher import SubstringMatcher
+from .searchmetrics import api_request
+from .transport import get_api_url, get_graphql_url
+from .tokens import token_manager
+
 
 logger = logging.getLogger('django')
 
@@ -47,6 +56,29 @@ topic_query = '''
     }
 '''
 
+keyword_id_field = '''
+        k%d:keywords(search:%s,se_id:29) {
+            keyword
+            keyword_id
+        }
+'''
+
+user_intent_field = '''
+        t%d:explore_topic(topic_id:%s, se_id:29) {
+            nodes{
+                text
+                user_intent{
+                    informational
+                    transactional
+                    navigational
+                }
+            }
+        }
+'''
+
+USER_INTENT_ENDPOINT = 'GraphQLUserIntent'
+DEFAULT_GRAPHQL_BATCH_SIZE = 100
+
 URL_REG_EXP = r'https?:\/\/[-a-zA-Z0-9@:%._\+~#=]{1,256}\/(.*?)$'
 URL_PARAMS_EXP = r'https?:\/\/[-a-zA-Z0-9@:%._\+~#=]{1,256}\/[-a-zA-Z0-9@:%._\+~#=]?(.*?)$'
 
@@ -80,35 +112,27 @@ def filtered_array(arr):
 
 
 def get_access_token(key, secret):
-    credentials = f'{key}:{secret}'
-    auth_encoded = credentials.encode('utf-8')
-    auth = str(base64.b64encode(auth_encoded), "utf-8")
-    headers = {'Authorization': f'Basic {auth}'}
-    data = {'grant_type': 'client_credentials'}
-    r = requests.post(url='https://api.searchmetrics.com/v4/token', headers=headers, data=data)
-    try:
-        access_token = r.json()['access_token']
-    except (KeyError, JSONDecodeError):
-        return None
-
-    return access_token
+    return token_manager.get_token(key, secret)
 
 
 def top_words(model, feature_names, n_top_words):
     return [feature_names[i] for i in model.components_[0].argsort()[:-n_top_words - 1:-1]]
 
 
-def add_to_dictionary(cat_dict, key, new_keyword, integration):
+def add_to_dictionary(cat_dict, key, new_keyword, integration, search_volume=None):
     integration = '' if not integration or integration == 'nan' or integration == np.nan \
                         or isinstance(integration, float) else integration
+    if search_volume is None:
+        search_volume = get_keyword_volume(new_keyword)
+
     if key not in cat_dict:
         cat_dict[key] = {'keywords': [new_keyword]}
         cat_dict[key]['integration'] = integration.split("|||")
-        cat_dict[key]['search_volume'] = [int(get_keyword_volume(new_keyword))]
+        cat_dict[key]['search_volume'] = [int(search_volume)]
     else:
         cat_dict[key]['keywords'].append(new_keyword)
         cat_dict[key]['integration'] += integration.split("|||")
-        cat_dict[key]['search_volume'].append(int(get_keyword_volume(new_keyword)))
+        cat_dict[key]['search_volume'].append(int(search_volume))
 
 
 def save_csv_file(csv_file, filename):
@@ -118,25 +142,40 @@ def save_csv_file(csv_file, filename):
     return uploaded_file_url
 
 
+def parse_country_codes(country_codes):
+    """
+    Splits comma or whitespace separated country codes, e.g. 'us, DE' -> ['us', 'de']
+    """
+    return list(dict.fromkeys(code.lower() for code in re.split(r'[\s,;]+', country_codes or '') if code))
+
+
+def validate_country_codes(country_codes):
+    codes = parse_country_codes(country_codes)
+    if not codes or any(not re.fullmatch(r'[a-z]{2,3}', code) for code in codes):
+        raise ValidationError(f'Invalid country codes: {country_codes}')
+
+
 def is_included(word, exclude_inner):
-    for exclude_word in exclude_inner:
-        if word.lower().find(exclude_word.lower()) != -1:
-            return True
-    return False
+    """
+    Returns True if any of exclude_inner, a list of words or a SubstringMatcher, is part of the word
+    """
+    if not isinstance(exclude_inner, SubstringMatcher):
+        exclude_inner = SubstringMatcher(exclude_inner)
+    return exclude_inner.search(word)
 
 
 def get_keyword_data(keyword, country_code, access_token):
     keyword = keyword.lower().strip()
-    api_url = 'http://api.searchmetrics.com/v3/ResearchKeywordsGetListKeywordinfo.json' \
-              f'?keyword={keyword}&countrycode={country_code}&access_token={access_token}'
-    response = requests.get(api_url)
+    api_url = get_api_url('v3/ResearchKeywordsGetListKeywordinfo.json')
+    response = api_request(api_url, params={'keyword': keyword, 'countrycode': country_code,
+                                            'access_token': access_token})
     return response, keyword
 
 
 def get_rankings_data(domain, country_code, access_token, offset):
-    api_url = 'http://api.searchmetrics.com/v3/ResearchOrganicGetListRankingsDomain.json' \
-              f'?url={domain}&countrycode={country_code}&access_token={access_token}&limit=250&offset={offset}'
-    response = requests.get(api_url)
+    api_url = get_api_url('v3/ResearchOrganicGetListRankingsDomain.json')
+    response = api_request(api_url, params={'url': domain, 'countrycode': country_code,
+                                            'access_token': access_token, 'limit': 250, 'offset': offset})
 
     try:
         data = response.json()
@@ -148,10 +187,19 @@ def get_rankings_data(domain, country_code, access_token, offset):
     return data
 
 
+def get_rankings_page(domain, country_code, access_token, offset):
+    data = get_rankings_data(domain, country_code, access_token, offset)
+
+    try:
+        return True, data['response']
+    except (KeyError, TypeError):
+        return False, None
+
+
 def get_list_rankings(access_token, domain, date, offset=0):
-    api_url = f'https://api.searchmetrics.com/v3/ResearchOrganicGetListRankingsDomainHistoric.json' \
-              f'?access_token={access_token}&url={domain}&countrycode=de&date={date}&limit=250&offset={offset}'
-    r = requests.get(url=api_url)
+    api_url = get_api_url('v3/ResearchOrganicGetListRankingsDomainHistoric.json')
+    r = api_request(api_url, params={'access_token': access_token, 'url': domain, 'countrycode': 'de',
+                                     'date': date, 'limit': 250, 'offset': offset})
 
     try:
         response = r.json(encoding='utf-8')["response"]
@@ -163,9 +211,9 @@ def get_list_rankings(access_token, domain, date, offset=0):
 
 
 def get_keywords_phrase(access_token, phrase, country_code):
-    api_url = f'https://api.searchmetrics.com/v4/ResearchKeywordsGetListSimilarKeywords.json' \
-              f'?access_token={access_token}&keyword={phrase}&countrycode={country_code}&limit=250'
-    r = requests.get(url=api_url)
+    api_url = get_api_url('v4/ResearchKeywordsGetListSimilarKeywords.json')
+    r = api_request(api_url, params={'access_token': access_token, 'keyword': phrase,
+                                     'countrycode': country_code, 'limit': 250})
 
     try:
         response = r.json(encoding='utf-8')["response"]
@@ -177,9 +225,9 @@ def get_keywords_phrase(access_token, phrase, country_code):
 
 
 def get_keyword_info(access_token, keyword, country_code):
-    api_url = f'https://api.searchmetrics.com/v4/ResearchOrganicGetListRankingsKeyword.json' \
-              f'?access_token={access_token}&keyword={keyword}&countrycode={country_code}&limit=25'
-    r = requests.get(url=api_url)
+    api_url = get_api_url('v4/ResearchOrganicGetListRankingsKeyword.json')
+    r = api_request(api_url, params={'access_token': access_token, 'keyword': keyword,
+                                     'countrycode': country_code, 'limit': 25})
 
     try:
         response = r.json(encoding='utf-8')["response"]
@@ -189,8 +237,10 @@ def get_keyword_info(access_token, keyword, country_code):
 
 
 def run_graphql_query(query):
-    request = requests.post('https://graphql.searchmetrics.com',
-                            json={'query': query}, headers=headers)
+    ratelimit.acquire('graphql')
+    request = transport.post(get_graphql_url(), json={'query': query}, headers=headers)
+    if request.status_code == 200:
+        record('graphql', {'query': query}, request)
 
     return request
 
@@ -230,17 +280,103 @@ def get_user_intents(keyword):
     return user_intent
 
 
+def _run_aliased_query(fields):
+    """
+    Runs one query made of aliased fields. Returns its data or None if the request failed
+    """
+    request = run_graphql_query('query {%s}' % ''.join(fields))
+    if request.status_code != 200:
+        return None
+
+    try:
+        return request.json()['data'] or {}
+    except (JSONDecodeError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _resolve_user_intents(keywords):
+    """
+    Resolves keyword ids with one query and user intents of the found topics with another.
+    Returns None if any of the queries failed
+    """
+    fields = [keyword_id_field % (index, json.dumps(keyword)) for index, keyword in enumerate(keywords)]
+    data = _run_aliased_query(fields)
+    if data is None:
+        return None
+
+    topic_ids = []
+    for index, keyword in enumerate(keywords):
+        for key in data.get(f'k{index}') or []:
+            if key.get('keyword') == keyword and key.get('keyword_id') is not None:
+                topic_ids.append((keyword, key['keyword_id']))
+                break
+
+    user_intents = dict.fromkeys(keywords)
+    if not topic_ids:
+        return user_intents
+
+    fields = [user_intent_field % (index, topic_id) for index, (_, topic_id) in enumerate(topic_ids)]
+    data = _run_aliased_query(fields)
+    if data is None:
+        return None
+
+    for index, (keyword, _) in enumerate(topic_ids):
+        for topic in (data.get(f't{index}') or {}).get('nodes') or []:
+            if topic.get('text') == keyword:
+                user_intents[keyword] = topic.get('user_intent')
+                break
+
+    return user_intents
+
+
+def get_user_intents_batch(keywords, batch_size=None):
+    """
+    Batch variant of get_user_intents: every batch of keywords takes two GraphQL requests
+    with aliased fields. Resolved intents are kept in the response cache by keyword, unknown
+    keywords are not, so they are queried again by the next job.
+    Returns dict of keyword and its user intent, None for unknown keywords or failed requests
+    """
+    batch_size = batch_size or getattr(settings, 'SEARCH_METRICS_GRAPHQL_BATCH_SIZE', DEFAULT_GRAPHQL_BATCH_SIZE)
+    cache = get_cache()
+    if cache is not None and not cache.is_cached_endpoint(USER_INTENT_ENDPOINT):
+        cache = None
+
+    user_intents, missing = {}, []
+    for keyword in dict.fromkeys(keywords):
+        cached = cache.get(USER_INTENT_ENDPOINT, {'keyword': keyword}) if cache is not None else None
+        user_intent = cached.json() if cached is not None else None
+        if user_intent is None:
+            missing.append(keyword)
+        else:
+            user_intents[keyword] = user_intent
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        resolved = _resolve_user_intents(batch)
+        if resolved is None:
+            logger.info(f"GraphQL: Could not resolve user intents of {len(batch)} keywords")
+            continue
+
+        user_intents.update(resolved)
+        if cache is not None:
+            for keyword, user_intent in resolved.items():
+                if user_intent is not None:
+                    cache.set(USER_INTENT_ENDPOINT, {'keyword': keyword}, 200,
+                              json.dumps(user_intent).encode('utf-8'))
+
+    return {keyword: user_intents.get(keyword) for keyword in keywords}
+
+
 def log_to_telegram_bot(message):
     api_url = "https://api.telegram.org/bot732949305:AAGHuNat21SBhRki1BOSUrWfQ8_37lGdo4I/sendMessage?" \
               f"chat_id=48355225&text={message}"
-    requests.get(url=api_url)
+    requests.get(url=api_url, timeout=transport.get_timeout())
 
 
 def get_keyword_volume(keyword):
     access_token = get_access_token(settings.SEARCH_METRICS_KEY, settings.SEARCH_METRICS_SECRET)
-    api_url = f'https://api.searchmetrics.com/v3/ResearchKeywordsGetListKeywordinfo.json?keyword={keyword}' \
-              f'&countrycode=us&access_token={access_token}'
-    r = requests.get(url=api_url)
+    api_url = get_api_url('v3/ResearchKeywordsGetListKeywordinfo.json')
+    r = api_request(api_url, params={'keyword': keyword, 'countrycode': 'us', 'access_token': access_token})
 
     try:
         search_volume = r.json(encoding='utf-8')["response"][0]["search_volume"]
@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from core.metrics import get_metrics
+
+
+class Command(BaseCommand):
+    help = "Dump per-endpoint latency, size, retry and error metrics of the Searchmetrics API calls"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help="Print raw summary as JSON")
+        parser.add_argument('--reset', action='store_true', help="Clear the metrics after dumping them")
+
+    def handle(self, *args, **options):
+        metrics = get_metrics()
+        if metrics is None:
+            self.stdout.write("API metrics are disabled with SEARCH_METRICS_METRICS_ENABLED")
+            return
+
+        summary = metrics.summary()
+        if options['json']:
+            self.stdout.write(json.dumps(summary, indent=2))
+        else:
+            self.stdout.write(f"{'endpoint':<48}{'calls':>8}{'cached':>8}{'avg s':>8}{'p95 s':>8}{'total s':>10}"
+                              f"{'MB':>8}  retries / errors")
+            for endpoint, stats in sorted(summary.items(), key=lambda item: -item[1]['latency_total']):
+                self.stdout.write(
+                    f"{endpoint:<48}{stats['calls']:>8}{stats['cache_hits']:>8}{stats['latency_avg'] or 0:>8}"
+                    f"{stats['latency_p95'] or 0:>8}{stats['latency_total']:>10}{stats['bytes'] / 2 ** 20:>8.2f}"
+                    f"  {stats['retries'] or '-'} / {stats['errors'] or '-'}"
+                )
+
+        if options['reset']:
+            metrics.reset()
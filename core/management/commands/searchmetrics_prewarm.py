@@ -0,0 +1,77 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import pandas as pd
+
+from core.batch import run_batch
+from core.cache import get_cache
+from core.helpers import get_access_token, get_keyword_data, get_keyword_info
+from core.planner import RequestPlan
+
+logger = logging.getLogger('django')
+
+
+def read_keywords(path):
+    if path.endswith('.csv'):
+        return list(pd.read_csv(path)['Keyword'].dropna())
+
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line for line in f.read().splitlines() if line.strip()]
+
+
+class Command(BaseCommand):
+    help = "Pre-fetch keyword info and keyword rankings of a keyword list into the Searchmetrics response cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument('keyword_file', help="csv file with Keyword column or text file with a keyword per line")
+        parser.add_argument('--countries', default='us', help="Comma separated country codes, e.g. us,de")
+        parser.add_argument('--key', default=None, help="API key, SEARCH_METRICS_KEY by default")
+        parser.add_argument('--secret', default=None, help="API secret, SEARCH_METRICS_SECRET by default")
+        parser.add_argument('--concurrency', type=int, default=None)
+        parser.add_argument('--skip-info', action='store_true', help="Do not fetch keyword info")
+        parser.add_argument('--skip-rankings', action='store_true', help="Do not fetch keyword rankings")
+
+    def handle(self, *args, **options):
+        if get_cache() is None:
+            raise CommandError("Response cache is disabled with SEARCH_METRICS_CACHE_ENABLED")
+
+        try:
+            keywords = read_keywords(options['keyword_file'])
+        except (OSError, KeyError, ValueError) as e:
+            raise CommandError(f"Could not read keywords: {e}")
+
+        access_token = get_access_token(options['key'] or settings.SEARCH_METRICS_KEY,
+                                        options['secret'] or settings.SEARCH_METRICS_SECRET)
+        if access_token is None:
+            raise CommandError("Could not receive access token")
+
+        countries = [country.strip() for country in options['countries'].split(',') if country.strip()]
+
+        jobs = []
+        for country_code in countries:
+            if not options['skip_info']:
+                jobs.append((
+                    f'keyword info ({country_code})',
+                    RequestPlan(keywords, 'v3/ResearchKeywordsGetListKeywordinfo', {'countrycode': country_code}),
+                    lambda keyword, country_code=country_code: get_keyword_data(keyword, country_code, access_token)
+                ))
+            if not options['skip_rankings']:
+                jobs.append((
+                    f'keyword rankings ({country_code})',
+                    RequestPlan(keywords, 'v4/ResearchOrganicGetListRankingsKeyword',
+                                {'countrycode': country_code, 'limit': 25}),
+                    lambda keyword, country_code=country_code: get_keyword_info(access_token, keyword, country_code)
+                ))
+
+        for name, plan, fetch in jobs:
+            summary = plan.summary()
+            self.stdout.write(f"{name}: {summary['unique_keywords']} keywords, {summary['cached']} cached, "
+                              f"{summary['api_calls']} to fetch")
+            if not plan.api_calls:
+                continue
+
+            results = run_batch(fetch, plan.unique, concurrency=options['concurrency'])
+            failed = sum(not result.ok for result in results)
+            self.stdout.write(f"{name}: done, {failed} failed")
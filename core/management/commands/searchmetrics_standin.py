@@ -0,0 +1,38 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from core.standin import StandInServer
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = "Run local stand-in of the Searchmetrics API serving recorded or synthetic responses"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--fixtures', default=None, help="Directory of responses recorded with "
+                                                             "SEARCH_METRICS_RECORD_DIR")
+        parser.add_argument('--latency', type=float, default=0.0, help="Mean response latency in seconds")
+        parser.add_argument('--jitter', type=float, default=0.0, help="Standard deviation of the latency")
+        parser.add_argument('--error-rate', type=float, default=0.0, help="Share of HTTP 500 responses")
+        parser.add_argument('--quota-rate', type=float, default=0.0, help="Share of HTTP 429 quota responses")
+        parser.add_argument('--token-lifetime', type=int, default=3600)
+        parser.add_argument('--domain-size', type=int, default=1000, help="Ranking rows of every domain")
+
+    def handle(self, *args, **options):
+        server = StandInServer((options['host'], options['port']), fixtures_dir=options['fixtures'],
+                               latency=options['latency'], latency_jitter=options['jitter'],
+                               error_rate=options['error_rate'], quota_rate=options['quota_rate'],
+                               token_lifetime=options['token_lifetime'], domain_size=options['domain_size'])
+
+        self.stdout.write(f"Searchmetrics stand-in is running at {server.url}\n"
+                          f"Set SEARCH_METRICS_API_URL and SEARCH_METRICS_GRAPHQL_URL to {server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
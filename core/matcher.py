@@ -0,0 +1,49 @@
+import re
+
+
+def _trie(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return trie
+
+
+def _trie_pattern(node):
+    # A word ending here already matches, longer words sharing the prefix cannot add a match
+    if '' in node:
+        return ''
+
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items())]
+    if len(branches) == 1:
+        return branches[0]
+    return '(?:' + '|'.join(branches) + ')'
+
+
+class SubstringMatcher:
+    """
+    Case-insensitive search for any of many words inside a text, compiled once into a regex
+    whose alternatives share their common prefixes, so a lookup costs about the same for
+    a handful or thousands of words
+
+    Attributes:
+        words (set): lowercased words searched for
+    """
+    def __init__(self, words):
+        self.words = {word.lower() for word in words}
+
+        self._matches_all = '' in self.words
+        self._pattern = re.compile(_trie_pattern(_trie(self.words))) if self.words and not self._matches_all else None
+
+    def search(self, text):
+        """
+        Returns True if any of the words is a substring of the lowercased text
+        """
+        if self._pattern is None:
+            return self._matches_all
+        return self._pattern.search(text.lower()) is not None
+
+    def __bool__(self):
+        return bool(self.words)
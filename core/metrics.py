@@ -0,0 +1,232 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+from time import monotonic
+
+from django.conf import settings
+
+logger = logging.getLogger('django')
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DEFAULT_FLUSH_INTERVAL = 5
+
+
+def _empty_stats():
+    return {'calls': 0, 'bytes': 0, 'latency_sum': 0.0, 'latency_max': 0.0,
+            'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'errors': {}, 'retries': {}, 'cache_hits': 0}
+
+
+def _merge(target, source):
+    for endpoint, stats in source.items():
+        merged = target.setdefault(endpoint, _empty_stats())
+        for name in ('calls', 'bytes', 'latency_sum', 'cache_hits'):
+            merged[name] += stats.get(name, 0)
+        merged['latency_max'] = max(merged['latency_max'], stats.get('latency_max', 0))
+        merged['latency_buckets'] = [a + b for a, b in zip(merged['latency_buckets'], stats['latency_buckets'])]
+        for name in ('errors', 'retries'):
+            for category, count in stats.get(name, {}).items():
+                merged[name][category] = merged[name].get(category, 0) + count
+    return target
+
+
+def latency_percentile(stats, percentile):
+    """
+    Returns upper bound of the histogram bucket containing the percentile, None without calls
+    """
+    total = sum(stats['latency_buckets'])
+    if not total:
+        return None
+
+    position = total * percentile / 100
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, stats['latency_buckets']):
+        seen += count
+        if seen >= position:
+            return bound
+    return stats['latency_max']
+
+
+def summarize(stats):
+    calls = stats['calls']
+    return {
+        'calls': calls,
+        'cache_hits': stats['cache_hits'],
+        'bytes': stats['bytes'],
+        'latency_avg': round(stats['latency_sum'] / calls, 3) if calls else None,
+        'latency_p50': latency_percentile(stats, 50),
+        'latency_p95': latency_percentile(stats, 95),
+        'latency_max': round(stats['latency_max'], 3),
+        'latency_total': round(stats['latency_sum'], 3),
+        'errors': stats['errors'],
+        'retries': stats['retries'],
+    }
+
+
+class APIMetrics:
+    """
+    Per-endpoint counters of the API calls. Every process collects them in memory and
+    periodically adds them to a JSON file guarded by an exclusive file lock, so the
+    dump covers all worker processes.
+
+    Attributes:
+        path (str): path of the shared metrics file
+        flush_interval (int): seconds between writes to the shared file
+    """
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self._pending = {}
+        self._flushed_at = monotonic()
+        self._lock = threading.Lock()
+
+    def _stats(self, endpoint):
+        stats = self._pending.get(endpoint)
+        if stats is None:
+            stats = self._pending[endpoint] = _empty_stats()
+        return stats
+
+    def _maybe_flush(self):
+        if monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def record_call(self, endpoint, latency, size=0):
+        with self._lock:
+            stats = self._stats(endpoint)
+            stats['calls'] += 1
+            stats['bytes'] += size
+            stats['latency_sum'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+
+            bucket = len(LATENCY_BUCKETS)
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    bucket = index
+                    break
+            stats['latency_buckets'][bucket] += 1
+        self._maybe_flush()
+
+    def _count(self, endpoint, name, category):
+        with self._lock:
+            counts = self._stats(endpoint)[name]
+            counts[category] = counts.get(category, 0) + 1
+        self._maybe_flush()
+
+    def record_error(self, endpoint, category):
+        self._count(endpoint, 'errors', category)
+
+    def record_retry(self, endpoint, reason):
+        self._count(endpoint, 'retries', reason)
+
+    def record_cache_hit(self, endpoint):
+        with self._lock:
+            self._stats(endpoint)['cache_hits'] += 1
+        self._maybe_flush()
+
+    def _update_file(self, update):
+        """
+        Applies update to the stored metrics under file lock and returns the result
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with os.fdopen(os.dup(fd), 'r+', encoding='utf-8') as f:
+                try:
+                    stored = json.loads(f.read() or '{}')
+                except ValueError:
+                    stored = {}
+
+                result = update(stored)
+                if result is not stored:
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(result, f)
+            return result
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = monotonic()
+
+        if not pending:
+            return
+
+        try:
+            self._update_file(lambda stored: _merge(dict(stored), pending))
+        except OSError as err:
+            logger.info(f"Metrics: Could not write API metrics to {self.path}: {err}")
+
+    def snapshot(self):
+        """
+        Returns raw metrics of all processes per endpoint
+        """
+        self.flush()
+        try:
+            return self._update_file(lambda stored: stored)
+        except OSError as err:
+            logger.info(f"Metrics: Could not read API metrics from {self.path}: {err}")
+            return {}
+
+    def summary(self):
+        return {endpoint: summarize(stats) for endpoint, stats in sorted(self.snapshot().items())}
+
+    def reset(self):
+        with self._lock:
+            self._pending = {}
+        self._update_file(lambda stored: {})
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    Returns process-wide metrics or None if they are disabled with SEARCH_METRICS_METRICS_ENABLED
+    """
+    global _metrics
+
+    if not getattr(settings, 'SEARCH_METRICS_METRICS_ENABLED', True):
+        return None
+
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = APIMetrics(
+                    path=getattr(settings, 'SEARCH_METRICS_METRICS_PATH',
+                                 os.path.join(tempfile.gettempdir(), 'searchmetrics_metrics.json')),
+                    flush_interval=getattr(settings, 'SEARCH_METRICS_METRICS_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+                )
+                atexit.register(_metrics.flush)
+    return _metrics
+
+
+def record_call(endpoint, latency, size=0):
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.record_call(endpoint, latency, size)
+
+
+def record_error(endpoint, category):
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.record_error(endpoint, category)
+
+
+def record_retry(endpoint, reason):
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.record_retry(endpoint, reason)
+
+
+def record_cache_hit(endpoint):
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.record_cache_hit(endpoint)
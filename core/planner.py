@@ -0,0 +1,53 @@
+from .batch import BatchResult, run_batch
+from .cache import get_cache
+
+
+def normalize_keyword(keyword):
+    return ' '.join(str(keyword).lower().split())
+
+
+class RequestPlan:
+    """
+    API calls of a keyword job after normalization and deduplication. Keywords differing
+    only in case or whitespace share one call, keywords with a cached response need none.
+
+    Attributes:
+        keywords (list): keywords of the original rows
+        normalized (list): normalized keyword of every row
+        unique (list): unique normalized keywords in the order of their first occurrence
+        cached (int): unique keywords already in the response cache of the endpoint
+    """
+    def __init__(self, keywords, endpoint=None, params=None):
+        self.keywords = list(keywords)
+        self.normalized = [normalize_keyword(keyword) for keyword in self.keywords]
+        self.unique = list(dict.fromkeys(self.normalized))
+        self.cached = self._count_cached(endpoint, params or {})
+
+    def _count_cached(self, endpoint, params):
+        cache = get_cache()
+        if cache is None or endpoint is None or not cache.is_cached_endpoint(endpoint):
+            return 0
+        return sum(cache.contains(endpoint, {**params, 'keyword': keyword}) for keyword in self.unique)
+
+    @property
+    def api_calls(self):
+        return len(self.unique) - self.cached
+
+    def summary(self):
+        return {
+            'rows': len(self.keywords),
+            'unique_keywords': len(self.unique),
+            'cached': self.cached,
+            'api_calls': self.api_calls,
+        }
+
+    def run(self, func, concurrency=None):
+        """
+        Calls func once per unique normalized keyword
+
+        Returns:
+            list of BatchResult for every original row, item is the original keyword
+        """
+        results = {result.item: result for result in run_batch(func, self.unique, concurrency=concurrency)}
+        return [BatchResult(keyword, results[normalized].value, results[normalized].error)
+                for keyword, normalized in zip(self.keywords, self.normalized)]
@@ -0,0 +1,107 @@
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+from time import sleep, time
+
+from django.conf import settings
+
+logger = logging.getLogger('django')
+
+DEFAULT_BUCKET = 'default'
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter shared by all worker processes. State of every bucket
+    is kept in a small file guarded by an exclusive file lock.
+
+    Attributes:
+        directory (str): directory of the bucket files
+        limits (dict): (requests per second, burst size) per endpoint, endpoints
+                       without own budget share the 'default' bucket if it is given,
+                       otherwise they are not limited
+    """
+    def __init__(self, directory, limits=None):
+        self.directory = directory
+        self.limits = limits or {}
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def bucket(self, endpoint):
+        return endpoint if endpoint in self.limits else DEFAULT_BUCKET
+
+    def _take(self, bucket, rate, burst):
+        """
+        Takes a token from the bucket. Returns 0 on success, otherwise seconds to wait
+        """
+        path = os.path.join(self.directory, f'{bucket}.bucket')
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            content = os.read(fd, 64).decode().split()
+            now = time()
+
+            try:
+                tokens, updated = float(content[0]), float(content[1])
+            except (IndexError, ValueError):
+                tokens, updated = float(burst), now
+
+            tokens = min(float(burst), tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, f'{tokens} {now}'.encode())
+            return wait
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def acquire(self, endpoint):
+        """
+        Blocks until the budget of the endpoint allows another request
+        """
+        bucket = self.bucket(endpoint)
+        limit = self.limits.get(bucket)
+        if not limit:
+            return
+
+        rate, burst = limit
+        while True:
+            wait = self._take(bucket, rate, burst)
+            if not wait:
+                return
+            sleep(wait)
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """
+    Returns process-wide rate limiter or None if SEARCH_METRICS_RATE_LIMITS is not configured
+    """
+    global _rate_limiter
+
+    limits = getattr(settings, 'SEARCH_METRICS_RATE_LIMITS', None)
+    if not limits:
+        return None
+
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                directory = getattr(settings, 'SEARCH_METRICS_RATE_LIMIT_DIR',
+                                    os.path.join(tempfile.gettempdir(), 'searchmetrics_rate_limits'))
+                _rate_limiter = RateLimiter(directory=directory, limits=limits)
+    return _rate_limiter
+
+
+def acquire(endpoint):
+    rate_limiter = get_rate_limiter()
+    if rate_limiter is not None:
+        rate_limiter.acquire(endpoint)
@@ -0,0 +1,69 @@
+"""
+Compact records of Searchmetrics response rows keeping only the fields used by the tools.
+Rows are decoded page by page, so the parsed JSON of a page is released right after it
+was converted and large domains do not keep full response dicts in memory.
+"""
+import logging
+import sys
+
+logger = logging.getLogger('django')
+
+
+class Record:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*(row[name] for name in cls.__slots__))
+
+    def __repr__(self):
+        values = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{self.__class__.__name__}({values})'
+
+
+class HistoricRanking(Record):
+    """
+    Row of ResearchOrganicGetListRankingsDomainHistoric. Keyword and url are interned, as the
+    same values repeat in the rankings of both compared dates
+    """
+    __slots__ = ('keyword', 'url', 'position', 'traffic_monthly', 'search_volume_monthly')
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(sys.intern(row['keyword']), sys.intern(row['url']), row['position'], row['traffic_monthly'],
+                   row['search_volume_monthly'])
+
+
+class KeywordRanking(Record):
+    """
+    Row of ResearchOrganicGetListRankingsKeyword
+    """
+    __slots__ = ('position', 'url', 'title', 'trend')
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['position'], row['url'], row['title'], row['trend']['trend'])
+
+
+class KeywordInfo(Record):
+    """
+    Row of ResearchKeywordsGetListKeywordinfo
+    """
+    __slots__ = ('keyword', 'search_volume', 'cpc', 'integration', 'competition')
+
+
+def decode(rows, record_class):
+    """
+    Converts response rows to records, rows missing the needed fields are skipped
+    """
+    records = []
+    for row in rows or []:
+        try:
+            records.append(record_class.from_row(row))
+        except (KeyError, TypeError) as err:
+            logger.info(f"Records: Skipped {record_class.__name__} row without field {err}: {row}")
+    return records
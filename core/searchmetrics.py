@@ -1,41 +1,212 @@
-import base64
+from hashlib import sha256
 import logging
 from json import JSONDecodeError
+from time import sleep
+
+from django.conf import settings
 
 import requests
 
+from . import hedging, metrics, ratelimit, transport
+from .batch import PAGE_SIZE, iter_pages
+from .cache import ResponseCache, get_cache
+from .circuit import CircuitOpenError, get_circuit_breaker
+from .fixtures import record
+from .singleflight import SingleFlight
+from .tokens import token_manager
+from .transport import endpoint_name
+
 logger = logging.getLogger('django')
 
+DEFAULT_QUOTA_RETRIES = 3
+DEFAULT_RETRY_AFTER = 1
+
+single_flight = SingleFlight()
+
+
+def get_error_message(response):
+    try:
+        data = response.json()
+    except (JSONDecodeError, ValueError):
+        return None
+
+    if not isinstance(data, dict):
+        return None
+
+    error = data.get('error_message') or data.get('error')
+    return error.lower() if isinstance(error, str) else None
+
+
+def is_auth_error(response):
+    if response.status_code == 401:
+        return True
+
+    error = get_error_message(response)
+    return error is not None and 'token' in error
+
+
+def is_quota_error(response):
+    if response.status_code == 429:
+        return True
+
+    error = get_error_message(response)
+    return error is not None and ('quota' in error or 'rate limit' in error)
+
+
+def has_response(response):
+    if response.status_code != 200:
+        return False
+
+    try:
+        data = response.json()
+    except (JSONDecodeError, ValueError):
+        return False
+
+    return isinstance(data, dict) and 'response' in data
+
+
+def is_outage(response):
+    """
+    Returns True if the endpoint itself is failing: a server error or a quota error left after
+    the retries. Per-keyword error messages, client errors and rejected tokens are answers of
+    a working endpoint and must not open its circuit for every other job
+    """
+    return response.status_code >= 500 or is_quota_error(response)
+
+
+def get_retry_after(response):
+    try:
+        return max(float(response.headers.get('Retry-After', DEFAULT_RETRY_AFTER)), 0)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+def _request(endpoint, method, url, params, **kwargs):
+    """
+    Sends request within the shared rate budget of the endpoint, waiting and retrying
+    when the API still answers with a quota error. Slow GET requests are hedged if enabled
+    """
+    retries = getattr(settings, 'SEARCH_METRICS_QUOTA_RETRIES', DEFAULT_QUOTA_RETRIES)
+
+    for attempt in range(retries + 1):
+        ratelimit.acquire(endpoint)
+        response = hedging.request(endpoint, method, url, params=params, **kwargs)
+
+        if not is_quota_error(response) or attempt == retries:
+            return response
+
+        retry_after = get_retry_after(response)
+        metrics.record_retry(endpoint, 'quota')
+        logger.info(f"API: Quota exceeded for {endpoint}, retrying in {retry_after}s.")
+        sleep(retry_after)
+
+
+def _send(url, params, method, **kwargs):
+    endpoint = endpoint_name(url)
+    access_token = params.get('access_token')
+    if access_token:
+        params['access_token'] = token_manager.current(access_token)
+
+    response = _request(endpoint, method, url, params, **kwargs)
+
+    if access_token and is_auth_error(response):
+        access_token = token_manager.refresh(params['access_token'])
+        if access_token:
+            params['access_token'] = access_token
+            metrics.record_retry(endpoint, 'auth')
+            response = _request(endpoint, method, url, params, **kwargs)
+
+    return response
+
+
+def _cached_request(cache, endpoint, url, params, method, **kwargs):
+    if cache is not None:
+        cached = cache.get(endpoint, params)
+        if cached is not None:
+            metrics.record_cache_hit(endpoint)
+            return cached
+
+    breaker = get_circuit_breaker()
+    if breaker is not None:
+        try:
+            breaker.before_call(endpoint)
+        except CircuitOpenError:
+            metrics.record_error(endpoint, 'circuit_open')
+            raise
+
+    try:
+        response = _send(url, params, method, **kwargs)
+    except requests.RequestException:
+        if breaker is not None:
+            breaker.record_failure(endpoint)
+        raise
+    except Exception:
+        if breaker is not None:
+            breaker.release(endpoint)
+        raise
+
+    if breaker is not None:
+        if is_outage(response):
+            breaker.record_failure(endpoint)
+        else:
+            breaker.record_success(endpoint)
+
+    succeeded = has_response(response)
+
+    if succeeded:
+        record(endpoint, params, response)
+        if cache is not None:
+            cache.set(endpoint, params, response.status_code, response.content)
+    elif response.status_code == 200:
+        metrics.record_error(endpoint, 'api_error')
+
+    return response
+
+
+def api_request(url, params=None, method='GET', use_cache=True, **kwargs):
+    """
+    Sends request to the Searchmetrics API. Concurrent identical GET requests with the same
+    access token share one HTTP call and successful responses of cached endpoints are served from the
+    response cache. A stale access token in params is swapped for the current one
+    and refreshed once if the API rejects it. Raises CircuitOpenError while the
+    endpoint keeps failing.
+    """
+    params = dict(params or {})
+    endpoint = endpoint_name(url)
+
+    if method != 'GET':
+        return _send(url, params, method, **kwargs)
+
+    cache = get_cache() if use_cache else None
+    if cache is not None and not cache.is_cached_endpoint(endpoint):
+        cache = None
+
+    # Calls of different credentials never share a flight, the cache key leaves the token out
+    access_token = params.get('access_token')
+    owner = sha256(access_token.encode('utf-8')).hexdigest() if access_token else None
+    return single_flight.do(
+        (url, owner, ResponseCache.make_key(endpoint, params)),
+        lambda: _cached_request(cache, endpoint, url, params, method, **kwargs)
+    )
+
 
 class SearchmetricsAPI:
 
-    api = 'https://api.searchmetrics.com/v4/'
+    api = 'v4/'
 
     def __init__(self, key=None, secret=None):
-        self._set_access_token(key, secret)
+        self.key = key
+        self.secret = secret
 
-    def _concatenate_api(self, api):
-        return self.api + api
-
-    def _set_access_token(self, key, secret):
-        credentials = f'{key}:{secret}'
-        auth_encoded = credentials.encode('utf-8')
-        auth = str(base64.b64encode(auth_encoded), "utf-8")
-        headers = {
-            'Authorization': f'Basic {auth}'
-        }
-        data = {
-            'grant_type': 'client_credentials'
-        }
-        r = requests.post(url=self._concatenate_api('token'), headers=headers, data=data)
+        if self.access_token is None:
+            logger.info(f"API: Could not receive access token with key: {key}.")
 
-        try:
-            access_token = r.json()['access_token']
-            self.access_token = access_token
-        except (KeyError, JSONDecodeError) as err:
-            logger.info(f"API: Could not receive access token with credentials: {credentials}. "
-                        f"Error message: {err}")
-            self.access_token = None
+    @property
+    def access_token(self):
+        return token_manager.get_token(self.key, self.secret)
+
+    def _concatenate_api(self, api):
+        return transport.get_api_url(self.api + api)
 
     @classmethod
     def _process_response(cls, response, api):
@@ -78,7 +249,7 @@ class SearchmetricsAPI:
         """
         keyword = keyword.lower().strip()
         api = self._concatenate_api('ResearchKeywordsGetListKeywordinfo.json')
-        response = requests.get(
+        response = api_request(
             api,
             params=
             {
@@ -104,14 +275,14 @@ class SearchmetricsAPI:
 
         """
         api = self._concatenate_api('ResearchOrganicGetListRankingsDomain.json')
-        response = requests.get(
+        response = api_request(
             api,
             params=
             {
                 'url': domain,
                 'countrycode': country_code,
                 'access_token': self.access_token,
-                'limit': 250,
+                'limit': PAGE_SIZE,
                 'offset': offset
             }
         )
@@ -120,12 +291,24 @@ class SearchmetricsAPI:
             api=api
         )
 
+    def iter_rankings_domain(self, domain, amount, country_code='us', concurrency=None):
+        """
+        Yields ranking rows of the domain page by page, up to amount rows
+        """
+        for status, response in iter_pages(
+                lambda offset: self.get_rankings_domain(domain=domain, country_code=country_code, offset=offset),
+                amount=amount,
+                concurrency=concurrency
+        ):
+            if status:
+                yield from response
+
     def get_rankings_domain_historic(self, domain, date, country_code='us', offset=0):
         """
 
         """
         api = self._concatenate_api('ResearchOrganicGetListRankingsDomainHistoric.json')
-        response = requests.get(
+        response = api_request(
             api,
             params=
             {
@@ -133,7 +316,7 @@ class SearchmetricsAPI:
                 'countrycode': country_code,
                 'access_token': self.access_token,
                 'date': date,
-                'limit': 250,
+                'limit': PAGE_SIZE,
                 'offset': offset
             }
         )
@@ -142,13 +325,26 @@ class SearchmetricsAPI:
             api=api
         )
 
+    def iter_rankings_domain_historic(self, domain, date, amount, country_code='us', concurrency=None):
+        """
+        Yields historic ranking rows of the domain page by page, up to amount rows
+        """
+        for status, response in iter_pages(
+                lambda offset: self.get_rankings_domain_historic(domain=domain, date=date,
+                                                                 country_code=country_code, offset=offset),
+                amount=amount,
+                concurrency=concurrency
+        ):
+            if status:
+                yield from response
+
     def get_list_similar_keywords(self, keyword, country_code='us'):
         """
 
         """
         keyword = keyword.lower().strip()
         api = self._concatenate_api('ResearchKeywordsGetListSimilarKeywords.json')
-        response = requests.get(
+        response = api_request(
             api,
             params=
             {
@@ -169,7 +365,7 @@ class SearchmetricsAPI:
         """
         keyword = keyword.lower().strip()
         api = self._concatenate_api('ResearchOrganicGetListRankingsKeyword.json')
-        response = requests.get(
+        response = api_request(
             api,
             params=
             {
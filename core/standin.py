@@ -0,0 +1,275 @@
+"""
+Local stand-in for the Searchmetrics API used for offline load and regression testing.
+
+It speaks the v3/v4 REST endpoints, the token endpoint and the GraphQL endpoint used
+by the client. Responses come from recorded fixtures (see core.fixtures) or are
+generated deterministically from the request parameters. Latency, error and quota
+responses can be injected. Point the client at it with SEARCH_METRICS_API_URL and
+SEARCH_METRICS_GRAPHQL_URL.
+"""
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import random
+import re
+import threading
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+from .fixtures import load_fixture
+from .transport import endpoint_name
+
+logger = logging.getLogger('django')
+
+WORDS = ['shoes', 'running', 'men', 'women', 'sale', 'black', 'white', 'red', 'nike', 'adidas', 'boots',
+         'sneakers', 'kids', 'leather', 'cheap', 'best', 'size', 'high', 'low', 'retro']
+INTEGRATIONS = ['image', 'video', 'news', 'shopping', 'knowledge_graph', 'people_also_ask']
+
+KEYWORDS_FIELD_EXP = r'(\w+)\s*:\s*keywords\(\s*search\s*:\s*"((?:[^"\\]|\\.)*)"'
+TOPIC_FIELD_EXP = r'(\w+)\s*:\s*explore_topic\(\s*topic_id\s*:\s*(\d+)'
+
+
+def _seed(*values):
+    return int(md5('|'.join(str(value) for value in values).encode('utf-8')).hexdigest()[:12], 16)
+
+
+def keyword_id(keyword):
+    return _seed('keyword', keyword) % 10 ** 9
+
+
+class SyntheticData:
+    """
+    Deterministic fake responses: the same parameters always produce the same data
+
+    Attributes:
+        domain_size (int): amount of ranking rows of every domain, pages after it are short or empty
+        topics (dict): keywords by the keyword_id returned from the keywords query
+    """
+    def __init__(self, domain_size=1000):
+        self.domain_size = domain_size
+        self.topics = {}
+
+    @staticmethod
+    def _keyword(rand, size=3):
+        return ' '.join(rand.sample(WORDS, rand.randint(1, size)))
+
+    def keyword_info(self, params):
+        keyword = params.get('keyword', '')
+        rand = random.Random(_seed('info', keyword, params.get('countrycode')))
+        return [{'keyword': keyword, 'search_volume': rand.randint(0, 100000), 'cpc': round(rand.random() * 5, 2),
+                 'competition': round(rand.random(), 2), 'trend': rand.randint(-5, 5),
+                 'integration': ','.join(rand.sample(INTEGRATIONS, rand.randint(1, 3)))}]
+
+    def rankings_keyword(self, params):
+        keyword = params.get('keyword', '')
+        rand = random.Random(_seed('rankings', keyword, params.get('countrycode')))
+        return [{'keyword': keyword, 'position': position, 'url': f'www.site{rand.randint(1, 50)}.com/'
+                                                                   f'{keyword.replace(" ", "-")}/{position}',
+                 'title': f'{keyword} {position}', 'trend': {'trend': rand.randint(-3, 3)}}
+                for position in range(1, int(params.get('limit', 25)) + 1)]
+
+    def similar_keywords(self, params):
+        rand = random.Random(_seed('similar', params.get('keyword'), params.get('countrycode')))
+        return [{'keyword': f"{params.get('keyword', '')} {self._keyword(rand, 2)}",
+                 'search_volume': rand.randint(0, 50000), 'cpc': rand.randint(0, 5),
+                 'integration': ','.join(rand.sample(INTEGRATIONS, 2))}
+                for _ in range(int(params.get('limit', 250)))]
+
+    def _domain_rows(self, params, historic=False):
+        offset, limit = int(params.get('offset', 0)), int(params.get('limit', 250))
+        domain = params.get('url', '')
+        rows = []
+        for index in range(offset, min(offset + limit, self.domain_size)):
+            rand = random.Random(_seed('domain', domain, params.get('countrycode'), index,
+                                       params.get('date') if historic else ''))
+            keyword = self._keyword(random.Random(_seed('domain-keyword', domain, index)))
+            url = f'{domain}/{rand.choice(WORDS)}/{keyword.replace(" ", "-")}'
+            if historic:
+                rows.append({'keyword': keyword, 'url': url, 'position': rand.randint(1, 100),
+                             'traffic_monthly': rand.randint(0, 5000), 'search_volume_monthly': rand.randint(0, 90000)})
+            else:
+                rows.append({'keyword': keyword, 'url': url, 'position': rand.randint(1, 100),
+                             'page': rand.randint(1, 10), 'title': keyword.title(), 'description': keyword,
+                             'traffic': rand.randint(0, 5000), 'competition': round(rand.random(), 2),
+                             'cpc': round(rand.random() * 5, 2), 'adbudget': rand.randint(0, 1000),
+                             'potential': rand.randint(0, 1000), 'avg_popularity': rand.randint(0, 100),
+                             'last_months_count': rand.randint(0, 12)})
+        return rows
+
+    def response(self, endpoint, params):
+        if endpoint == 'ResearchKeywordsGetListKeywordinfo':
+            return self.keyword_info(params)
+        if endpoint == 'ResearchOrganicGetListRankingsKeyword':
+            return self.rankings_keyword(params)
+        if endpoint == 'ResearchKeywordsGetListSimilarKeywords':
+            return self.similar_keywords(params)
+        if endpoint == 'ResearchOrganicGetListRankingsDomain':
+            return self._domain_rows(params)
+        if endpoint == 'ResearchOrganicGetListRankingsDomainHistoric':
+            return self._domain_rows(params, historic=True)
+        return None
+
+    def graphql(self, query):
+        data = {}
+        for alias, keyword in re.findall(KEYWORDS_FIELD_EXP, query):
+            keyword = keyword.replace('\\"', '"')
+            self.topics[keyword_id(keyword)] = keyword
+            rand = random.Random(_seed('graphql', keyword))
+            data[alias] = [{'keyword': keyword, 'search_volume': rand.randint(0, 100000),
+                            'cpc': round(rand.random() * 5, 2), 'keyword_id': keyword_id(keyword)}]
+
+        for alias, topic_id in re.findall(TOPIC_FIELD_EXP, query):
+            keyword = self.topics.get(int(topic_id))
+            rand = random.Random(_seed('topic', topic_id))
+            intent = [rand.random() for _ in range(3)]
+            total = sum(intent)
+            nodes = [{'id': int(topic_id), 'traffic_index': rand.randint(0, 1000), 'text': keyword,
+                      'user_intent': {'informational': round(intent[0] / total, 2),
+                                      'transactional': round(intent[1] / total, 2),
+                                      'navigational': round(intent[2] / total, 2)}}] if keyword else []
+            data[alias] = {'nodes': nodes}
+        return data
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server_version = 'SearchmetricsStandIn/1.0'
+
+    def log_message(self, format, *args):
+        logger.debug(f"Stand-in: {format % args}")
+
+    def _send_json(self, status_code, data, headers=None):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _injected_failure(self):
+        """
+        Sleeps for the configured latency and returns True if an error or a quota
+        response was sent instead of the real one
+        """
+        server = self.server
+        latency = max(random.gauss(server.latency, server.latency_jitter), 0) if server.latency else 0
+        if latency:
+            sleep(latency)
+
+        roll = random.random()
+        if roll < server.quota_rate:
+            self._send_json(429, {'error_message': 'Quota exceeded, rate limit reached'}, {'Retry-After': '1'})
+            return True
+        if roll < server.quota_rate + server.error_rate:
+            self._send_json(500, {'error_message': 'Internal server error'})
+            return True
+        return False
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        body = self._read_body()
+
+        if parsed.path.endswith('/token'):
+            self._send_json(200, self.server.issue_token())
+            return
+
+        if self._injected_failure():
+            return
+
+        try:
+            query = json.loads(body.decode('utf-8'))['query']
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {'errors': [{'message': 'Query is missing'}]})
+            return
+
+        fixture = self.server.fixture('graphql', {'query': query})
+        if fixture:
+            self._send_json(*fixture)
+            return
+
+        self._send_json(200, {'data': self.server.synthetic.graphql(query)})
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        endpoint = endpoint_name(parsed.path)
+        params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+
+        if self._injected_failure():
+            return
+
+        if self.server.require_auth and params.get('access_token') not in self.server.tokens:
+            self._send_json(401, {'error_message': 'Invalid access token'})
+            return
+
+        fixture = self.server.fixture(endpoint, params)
+        if fixture:
+            self._send_json(*fixture)
+            return
+
+        # Synthetic data only depends on the method, not on the API version
+        response = self.server.synthetic.response(endpoint.rsplit('/', 1)[-1], params)
+        if response is None:
+            self._send_json(404, {'error_message': f'Unknown method {endpoint}'})
+            return
+
+        self._send_json(200, {'response': response})
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Stand-in Searchmetrics API server
+
+    Attributes:
+        fixtures_dir (str): directory of recorded fixtures, synthetic data is used for the rest
+        latency (float): mean response latency in seconds
+        latency_jitter (float): standard deviation of the latency
+        error_rate (float): share of requests answered with HTTP 500
+        quota_rate (float): share of requests answered with HTTP 429 quota errors
+        token_lifetime (int): expires_in of the issued access tokens
+        domain_size (int): ranking rows of every synthetic domain
+        require_auth (bool): reject REST calls without an issued access token
+    """
+    daemon_threads = True
+
+    def __init__(self, address, fixtures_dir=None, latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                 quota_rate=0.0, token_lifetime=3600, domain_size=1000, require_auth=True):
+        super().__init__(address, StandInHandler)
+
+        self.fixtures_dir = fixtures_dir
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.token_lifetime = token_lifetime
+        self.require_auth = require_auth
+        self.synthetic = SyntheticData(domain_size=domain_size)
+
+        self.tokens = set()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def issue_token(self):
+        with self._lock:
+            access_token = f'standin-{len(self.tokens) + 1}'
+            self.tokens.add(access_token)
+        return {'access_token': access_token, 'token_type': 'bearer', 'expires_in': self.token_lifetime}
+
+    def fixture(self, endpoint, params):
+        if not self.fixtures_dir:
+            return None
+        return load_fixture(self.fixtures_dir, endpoint, params)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
@@ -1,28 +1,58 @@
 import logging
+import os
+import tempfile
+import threading
+from time import sleep, time
+from unittest import mock
+
+import requests
 
 from django.conf import settings
-from django.test import TestCase
+from django.core.exceptions import ValidationError
+from django.test import TestCase, override_settings
 
-from .searchmetrics import SearchmetricsAPI
+from .batch import iter_pages, run_batch
+from .cache import ResponseCache
+from .circuit import CircuitBreaker, CircuitOpenError
+from .fixtures import load_fixture, save_fixture
+from .hedging import HedgedClient, LatencyTracker
+from .helpers import get_user_intents_batch, parse_country_codes, run_graphql_query, validate_country_codes
+from .matcher import SubstringMatcher
+from .metrics import APIMetrics
+from .planner import RequestPlan
+from .ratelimit import RateLimiter
+from .records import HistoricRanking, KeywordRanking, decode
+from .searchmetrics import SearchmetricsAPI, _cached_request, api_request
+from .singleflight import SingleFlight
+from .standin import StandInServer
+from .tokens import TokenManager
+from .transport import endpoint_name, get_api_url
 
 logger = logging.getLogger('django')
 
-api = SearchmetricsAPI(key=settings.SEARCH_METRICS_KEY, secret=settings.SEARCH_METRICS_SECRET)
-
 
 class SearchmetricsAPITest(TestCase):
+    """
+    Calls the live API, skipped unless it is reachable with the configured credentials
+    """
     def setUp(self):
-        return
+        try:
+            self.api = SearchmetricsAPI(key=settings.SEARCH_METRICS_KEY, secret=settings.SEARCH_METRICS_SECRET)
+            access_token = self.api.access_token
+        except requests.RequestException as err:
+            self.skipTest(f"Searchmetrics API is not reachable: {err}")
+        if access_token is None:
+            self.skipTest("Searchmetrics API did not issue an access token")
 
     def test_list_keyword_info(self):
-        status, response = api.get_list_keyword_info(
+        status, response = self.api.get_list_keyword_info(
             keyword='shoes',
             country_code='us',
         )
         self.assertEquals(status, True)
 
     def test_list_keyword_info_sv(self):
-        status, response = api.get_list_keyword_info(
+        status, response = self.api.get_list_keyword_info(
             keyword='shoes',
             country_code='us',
             return_sv=True
@@ -30,14 +60,14 @@ class SearchmetricsAPITest(TestCase):
         self.assertEquals(status, True)
 
     def test_rankings_domain(self):
-        status, response = api.get_rankings_domain(
+        status, response = self.api.get_rankings_domain(
             domain='zappos.com',
             country_code='us',
         )
         self.assertEquals(status, True)
 
     def test_rankings_domain_historic(self):
-        status, response = api.get_rankings_domain_historic(
+        status, response = self.api.get_rankings_domain_historic(
             domain='zappos.com',
             country_code='us',
             date='20190922'
@@ -45,15 +75,398 @@ class SearchmetricsAPITest(TestCase):
         self.assertEquals(status, True)
 
     def test_list_similar_keywords(self):
-        status, response = api.get_list_similar_keywords(
+        status, response = self.api.get_list_similar_keywords(
             keyword='shoes',
             country_code='us',
         )
         self.assertEquals(status, True)
 
     def test_list_rankings_keyword(self):
-        status, response = api.get_list_rankings_keyword(
+        status, response = self.api.get_list_rankings_keyword(
             keyword='shoes',
             country_code='us',
         )
         self.assertEquals(status, True)
+
+
+class TokenManagerTest(TestCase):
+    def setUp(self):
+        self.manager = TokenManager(expiry_margin=60)
+        self.responses = iter([{'access_token': 'first', 'expires_in': 3600},
+                               {'access_token': 'second', 'expires_in': 3600}])
+
+    def _post(self, *args, **kwargs):
+        response = mock.Mock()
+        response.json.return_value = next(self.responses)
+        return response
+
+    def test_token_is_cached(self):
+        with mock.patch('core.tokens.transport.post', side_effect=self._post) as post:
+            self.assertEquals(self.manager.get_token('key', 'secret'), 'first')
+            self.assertEquals(self.manager.get_token('key', 'secret'), 'first')
+            self.assertEquals(post.call_count, 1)
+
+    def test_refresh_after_auth_error(self):
+        with mock.patch('core.tokens.transport.post', side_effect=self._post) as post:
+            self.manager.get_token('key', 'secret')
+            self.assertEquals(self.manager.refresh('first'), 'second')
+            self.assertEquals(self.manager.refresh('first'), 'second')
+            self.assertEquals(self.manager.current('first'), 'second')
+            self.assertEquals(post.call_count, 2)
+
+
+class RunBatchTest(TestCase):
+    def test_results_keep_input_order(self):
+        results = run_batch(lambda number: number * 2, range(50), concurrency=8)
+        self.assertEquals([result.value for result in results], [number * 2 for number in range(50)])
+
+    def test_errors_are_kept_per_item(self):
+        results = run_batch(lambda number: 10 // number, [1, 0, 5], concurrency=2)
+        self.assertEquals([result.ok for result in results], [True, False, True])
+        self.assertIsInstance(results[1].error, ZeroDivisionError)
+
+
+class IterPagesTest(TestCase):
+    def test_stops_after_short_page(self):
+        requested = []
+
+        def fetch_page(offset):
+            requested.append(offset)
+            return True, list(range(offset, offset + (250 if offset < 500 else 10)))
+
+        rows = [row for _, page in iter_pages(fetch_page, amount=10000, concurrency=2) for row in page]
+        self.assertEquals(rows, list(range(510)))
+        self.assertLessEqual(max(requested), 750)
+
+
+class ResponseCacheTest(TestCase):
+    endpoint = 'v3/ResearchKeywordsGetListKeywordinfo'
+
+    def setUp(self):
+        self.cache = ResponseCache(path=os.path.join(tempfile.mkdtemp(), 'cache.sqlite3'), max_entries=5)
+
+    def test_keyword_is_normalized(self):
+        self.cache.set(self.endpoint, {'keyword': 'shoes', 'countrycode': 'us', 'access_token': 'first'},
+                       200, b'{"response": []}')
+        response = self.cache.get(self.endpoint, {'keyword': ' Shoes', 'countrycode': 'US', 'access_token': 'second'})
+        self.assertEquals(response.json(), {'response': []})
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_expired_entry_is_a_miss(self):
+        self.cache.ttls = {self.endpoint: -1}
+        self.cache.set(self.endpoint, {'keyword': 'shoes'}, 200, b'{"response": []}')
+        self.assertIsNone(self.cache.get(self.endpoint, {'keyword': 'shoes'}))
+        self.assertEquals(self.cache.misses, 1)
+
+    def test_eviction_keeps_size_bounded(self):
+        for number in range(10):
+            self.cache.set(self.endpoint, {'keyword': str(number)}, 200, b'{"response": []}')
+        self.cache.evict()
+        self.assertLessEqual(self.cache.stats()['entries'][self.endpoint], 5)
+
+    def test_api_versions_do_not_share_entries(self):
+        self.cache.set(self.endpoint, {'keyword': 'shoes'}, 200, b'{"response": []}')
+        self.assertIsNone(self.cache.get('v4/ResearchKeywordsGetListKeywordinfo', {'keyword': 'shoes'}))
+        self.assertEquals(endpoint_name(get_api_url('v4/ResearchKeywordsGetListKeywordinfo.json')),
+                          'v4/ResearchKeywordsGetListKeywordinfo')
+
+
+class RateLimiterTest(TestCase):
+    def test_requests_beyond_burst_wait_for_tokens(self):
+        rate_limiter = RateLimiter(directory=tempfile.mkdtemp(), limits={'default': (20, 5)})
+        started = time()
+        for _ in range(15):
+            rate_limiter.acquire('ResearchKeywordsGetListKeywordinfo')
+        self.assertGreaterEqual(time() - started, 0.45)
+
+    def test_endpoints_without_budget_are_not_limited(self):
+        rate_limiter = RateLimiter(directory=tempfile.mkdtemp(),
+                                   limits={'ResearchOrganicGetListRankingsDomain': (1, 1)})
+        started = time()
+        for _ in range(15):
+            rate_limiter.acquire('ResearchKeywordsGetListKeywordinfo')
+        self.assertLess(time() - started, 0.5)
+
+
+class APIMetricsTest(TestCase):
+    def test_metrics_of_processes_are_merged(self):
+        path = os.path.join(tempfile.mkdtemp(), 'metrics.json')
+        first, second = APIMetrics(path), APIMetrics(path)
+
+        first.record_call('ResearchKeywordsGetListKeywordinfo', 0.2, 100)
+        first.record_retry('ResearchKeywordsGetListKeywordinfo', 'quota')
+        second.record_call('ResearchKeywordsGetListKeywordinfo', 3, 50)
+        second.record_error('ResearchKeywordsGetListKeywordinfo', 'server_error')
+        second.flush()
+
+        summary = first.summary()['ResearchKeywordsGetListKeywordinfo']
+        self.assertEquals(summary['calls'], 2)
+        self.assertEquals(summary['bytes'], 150)
+        self.assertEquals(summary['latency_p50'], 0.25)
+        self.assertEquals(summary['latency_p95'], 5)
+        self.assertEquals(summary['retries'], {'quota': 1})
+        self.assertEquals(summary['errors'], {'server_error': 1})
+
+
+class RecordsTest(TestCase):
+    def test_rows_are_decoded_to_records(self):
+        rows = [{'keyword': 'shoes', 'url': 'www.example.com/shoes', 'position': 3, 'traffic_monthly': 10,
+                 'search_volume_monthly': 1000, 'cpc': 1.5},
+                {'keyword': 'boots', 'url': 'www.example.com/boots'}]
+        records = decode(rows, HistoricRanking)
+
+        self.assertEquals(len(records), 1)
+        self.assertEquals((records[0].keyword, records[0].position, records[0].search_volume_monthly),
+                          ('shoes', 3, 1000))
+        self.assertFalse(hasattr(records[0], '__dict__'))
+
+    def test_keyword_ranking_keeps_trend_value(self):
+        row = {'position': 1, 'url': 'www.example.com', 'title': 'Shoes', 'trend': {'trend': -2}}
+        self.assertEquals(KeywordRanking.from_row(row).trend, -2)
+
+
+class HedgedClientTest(TestCase):
+    def setUp(self):
+        self.tracker = LatencyTracker(min_delay=0.05, min_samples=5)
+        for _ in range(5):
+            self.tracker.add('ResearchKeywordsGetListKeywordinfo', 0.01)
+        self.client = HedgedClient(self.tracker, workers=4)
+
+    def test_slow_request_is_hedged(self):
+        responses = iter([(1, 'slow'), (0, 'fast')])
+
+        def request(method, url, **kwargs):
+            delay, response = next(responses)
+            sleep(delay)
+            return response
+
+        started = time()
+        with mock.patch('core.hedging.transport.request', side_effect=request), \
+                mock.patch('core.hedging.ratelimit.acquire'):
+            response = self.client.request('ResearchKeywordsGetListKeywordinfo', 'GET', 'url', params={})
+
+        self.assertEquals(response, 'fast')
+        self.assertLess(time() - started, 0.5)
+
+    def test_endpoint_without_samples_is_not_hedged(self):
+        self.assertIsNone(self.tracker.hedge_delay('ResearchOrganicGetListRankingsDomain'))
+        self.assertEquals(self.tracker.hedge_delay('ResearchKeywordsGetListKeywordinfo'), 0.05)
+
+
+class CircuitBreakerTest(TestCase):
+    endpoint = 'v3/ResearchKeywordsGetListKeywordinfo'
+
+    def test_circuit_opens_after_consecutive_failures_and_probes(self):
+        breaker = CircuitBreaker(failure_threshold=3, cooldown=0.1)
+        for _ in range(3):
+            breaker.before_call(self.endpoint)
+            breaker.record_failure(self.endpoint)
+
+        self.assertRaises(CircuitOpenError, breaker.before_call, self.endpoint)
+
+        sleep(0.15)
+        breaker.before_call(self.endpoint)
+        self.assertRaises(CircuitOpenError, breaker.before_call, self.endpoint)
+
+        breaker.record_success(self.endpoint)
+        breaker.before_call(self.endpoint)
+
+    def test_failed_probe_opens_circuit_again(self):
+        breaker = CircuitBreaker(failure_threshold=1, cooldown=0.1)
+        breaker.record_failure(self.endpoint)
+        sleep(0.15)
+        breaker.before_call(self.endpoint)
+        breaker.record_failure(self.endpoint)
+
+        self.assertRaises(CircuitOpenError, breaker.before_call, self.endpoint)
+
+    def test_only_outages_open_circuit(self):
+        breaker = CircuitBreaker(failure_threshold=3, cooldown=30)
+        url = get_api_url('v3/ResearchKeywordsGetListKeywordinfo.json')
+        no_data = mock.Mock(status_code=200, json=lambda: {'error_message': 'No data for keyword'})
+        server_error = mock.Mock(status_code=503, json=lambda: {})
+
+        with mock.patch('core.searchmetrics.get_circuit_breaker', return_value=breaker), \
+                mock.patch('core.searchmetrics.record'):
+            with mock.patch('core.searchmetrics._send', return_value=no_data):
+                for _ in range(5):
+                    _cached_request(None, self.endpoint, url, {'keyword': 'unknown'}, 'GET')
+            self.assertEquals(breaker.state(self.endpoint), 'closed')
+
+            with mock.patch('core.searchmetrics._send', return_value=server_error):
+                for _ in range(3):
+                    _cached_request(None, self.endpoint, url, {'keyword': 'shoes'}, 'GET')
+            self.assertEquals(breaker.state(self.endpoint), 'open')
+
+    def test_other_errors_keep_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, cooldown=0.1)
+        url = get_api_url('v3/ResearchKeywordsGetListKeywordinfo.json')
+
+        with mock.patch('core.searchmetrics.get_circuit_breaker', return_value=breaker):
+            with mock.patch('core.searchmetrics._send', side_effect=requests.exceptions.ChunkedEncodingError):
+                self.assertRaises(requests.exceptions.ChunkedEncodingError, _cached_request,
+                                  None, self.endpoint, url, {'keyword': 'shoes'}, 'GET')
+            with mock.patch('core.searchmetrics._send', side_effect=ValueError):
+                self.assertRaises(ValueError, _cached_request, None, self.endpoint, url, {'keyword': 'shoes'}, 'GET')
+            with mock.patch('core.searchmetrics._send', side_effect=requests.Timeout):
+                self.assertRaises(requests.Timeout, _cached_request,
+                                  None, self.endpoint, url, {'keyword': 'shoes'}, 'GET')
+            self.assertEquals(breaker.state(self.endpoint), 'open')
+
+            sleep(0.15)
+            with mock.patch('core.searchmetrics._send', side_effect=ValueError):
+                self.assertRaises(ValueError, _cached_request, None, self.endpoint, url, {'keyword': 'shoes'}, 'GET')
+            breaker.before_call(self.endpoint)
+            self.assertEquals(breaker.state(self.endpoint), 'half-open')
+
+
+class RequestPlanTest(TestCase):
+    endpoint = 'v3/ResearchKeywordsGetListKeywordinfo'
+
+    def test_duplicates_share_one_call_and_results_fan_out(self):
+        cache = ResponseCache(path=os.path.join(tempfile.mkdtemp(), 'cache.sqlite3'))
+        cache.set(self.endpoint, {'keyword': 'boots', 'countrycode': 'us'}, 200, b'{"response": []}')
+
+        with mock.patch('core.planner.get_cache', return_value=cache):
+            plan = RequestPlan(['Shoes', ' shoes ', 'red  shoes', 'Red Shoes', 'boots'], self.endpoint,
+                               {'countrycode': 'us'})
+
+        self.assertEquals(plan.summary(), {'rows': 5, 'unique_keywords': 3, 'cached': 1, 'api_calls': 2})
+
+        calls = []
+        results = plan.run(lambda keyword: calls.append(keyword) or keyword.upper())
+        self.assertEquals(sorted(calls), ['boots', 'red shoes', 'shoes'])
+        self.assertEquals([(result.item, result.value) for result in results],
+                          [('Shoes', 'SHOES'), (' shoes ', 'SHOES'), ('red  shoes', 'RED SHOES'),
+                           ('Red Shoes', 'RED SHOES'), ('boots', 'BOOTS')])
+
+
+class SingleFlightTest(TestCase):
+    def test_concurrent_calls_share_one_result(self):
+        single_flight = SingleFlight()
+        calls, results = [], []
+
+        def lookup():
+            calls.append(1)
+            sleep(0.1)
+            return 'shoes'
+
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do('shoes:us', lookup)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(results, ['shoes'] * 5)
+
+    def test_requests_of_different_tokens_are_not_shared(self):
+        calls = []
+
+        def cached_request(cache, endpoint, url, params, method, **kwargs):
+            calls.append(params['access_token'])
+            sleep(0.1)
+            return params['access_token']
+
+        url = get_api_url('v3/ResearchKeywordsGetListKeywordinfo.json')
+        results = []
+        threads = [threading.Thread(target=lambda token=token: results.append(
+            api_request(url, {'keyword': 'shoes', 'access_token': token}, use_cache=False)))
+            for token in ('first', 'second', 'first')]
+        with mock.patch('core.searchmetrics._cached_request', side_effect=cached_request):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEquals(sorted(calls), ['first', 'second'])
+        self.assertEquals(sorted(results), ['first', 'first', 'second'])
+
+
+class StandInServerTest(TestCase):
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), domain_size=600)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_client_pages_through_synthetic_domain(self):
+        with override_settings(SEARCH_METRICS_API_URL=self.server.url, SEARCH_METRICS_CACHE_ENABLED=False,
+                               SEARCH_METRICS_RATE_LIMITS={}):
+            standin_api = SearchmetricsAPI(key='standin', secret='standin')
+            rows = list(standin_api.iter_rankings_domain('www.example.com', 1000))
+
+        self.assertEquals(len(rows), 600)
+        self.assertEquals(len(self.server.tokens), 1)
+
+    def test_fixtures_of_api_versions_are_kept_apart(self):
+        fixtures_dir = tempfile.mkdtemp()
+        params = {'keyword': 'shoes', 'countrycode': 'us'}
+        save_fixture(fixtures_dir, 'v3/ResearchKeywordsGetListKeywordinfo', params, 200, b'{"response": [3]}')
+        save_fixture(fixtures_dir, 'v4/ResearchKeywordsGetListKeywordinfo', params, 200, b'{"response": [4]}')
+        self.assertEquals(load_fixture(fixtures_dir, 'v3/ResearchKeywordsGetListKeywordinfo', params),
+                          (200, b'{"response": [3]}'))
+        self.assertEquals(load_fixture(fixtures_dir, 'v4/ResearchKeywordsGetListKeywordinfo', params),
+                          (200, b'{"response": [4]}'))
+
+    def test_user_intents_are_resolved_in_batches_and_cached(self):
+        keywords = [f'keyword {number}' for number in range(25)]
+        cache = ResponseCache(path=os.path.join(tempfile.mkdtemp(), 'cache.sqlite3'))
+
+        with override_settings(SEARCH_METRICS_GRAPHQL_URL=self.server.url, SEARCH_METRICS_RATE_LIMITS={}), \
+                mock.patch('core.helpers.get_cache', return_value=cache), \
+                mock.patch('core.helpers.run_graphql_query', wraps=run_graphql_query) as query:
+            user_intents = get_user_intents_batch(keywords, batch_size=10)
+            self.assertEquals(query.call_count, 6)
+            self.assertEquals(get_user_intents_batch(keywords, batch_size=10), user_intents)
+            self.assertEquals(query.call_count, 6)
+
+        self.assertTrue(all(user_intents[keyword] for keyword in keywords))
+
+    def test_unknown_user_intents_are_not_cached(self):
+        cache = ResponseCache(path=os.path.join(tempfile.mkdtemp(), 'cache.sqlite3'))
+
+        with mock.patch('core.helpers.get_cache', return_value=cache), \
+                mock.patch('core.helpers._resolve_user_intents',
+                           side_effect=lambda keywords: {keyword: None for keyword in keywords}) as resolve:
+            self.assertEquals(get_user_intents_batch(['unknown keyword']), {'unknown keyword': None})
+            get_user_intents_batch(['unknown keyword'])
+
+        self.assertEquals(resolve.call_count, 2)
+        self.assertEquals(cache.stats()['entries'], {})
+
+    def test_user_intents_are_not_cached_without_ttl(self):
+        cache = ResponseCache(path=os.path.join(tempfile.mkdtemp(), 'cache.sqlite3'), ttls={})
+
+        with mock.patch('core.helpers.get_cache', return_value=cache), \
+                mock.patch('core.helpers._resolve_user_intents',
+                           side_effect=lambda keywords: {keyword: 'informational' for keyword in keywords}):
+            self.assertEquals(get_user_intents_batch(['shoes']), {'shoes': 'informational'})
+
+        self.assertEquals(cache.stats()['entries'], {})
+
+
+class CountryCodesTest(TestCase):
+    def test_country_codes_are_split_and_deduplicated(self):
+        self.assertEquals(parse_country_codes('us, DE;fr us\tuk'), ['us', 'de', 'fr', 'uk'])
+        self.assertEquals(parse_country_codes('de'), ['de'])
+
+    def test_invalid_country_codes_are_rejected(self):
+        validate_country_codes('us,de')
+        for value in ('', 'us,germany', 'u1'):
+            with self.assertRaises(ValidationError):
+                validate_country_codes(value)
+
+
+class SubstringMatcherTest(TestCase):
+    def test_words_are_matched_inside_text_ignoring_case(self):
+        matcher = SubstringMatcher(['Nik', 'adi', 'adidas', 'puma'])
+        self.assertTrue(matcher.search('NIKE'))
+        self.assertTrue(matcher.search('shoes-adidas'))
+        self.assertFalse(matcher.search('reebok'))
+
+    def test_empty_word_list_matches_nothing(self):
+        self.assertFalse(SubstringMatcher([]).search('nike'))
@@ -0,0 +1,109 @@
+import base64
+from json import JSONDecodeError
+import logging
+import threading
+from time import monotonic
+
+from django.conf import settings
+
+from . import transport
+
+logger = logging.getLogger('django')
+
+DEFAULT_TOKEN_LIFETIME = 3600
+DEFAULT_EXPIRY_MARGIN = 60
+
+
+class TokenManager:
+    """
+    Process-wide cache of Searchmetrics OAuth access tokens.
+
+    Tokens are cached per (key, secret) pair until shortly before they expire.
+    Every issued token remembers its credentials, so a caller holding an old
+    token can be switched to the current one or refresh it after an auth error.
+
+    Attributes:
+        token_url (str): url of the OAuth token endpoint, SEARCH_METRICS_API_URL based by default
+        expiry_margin (int): seconds before expiry when the token is renewed
+    """
+    def __init__(self, token_url=None, expiry_margin=None):
+        if expiry_margin is None:
+            expiry_margin = getattr(settings, 'SEARCH_METRICS_TOKEN_EXPIRY_MARGIN', DEFAULT_EXPIRY_MARGIN)
+
+        self.token_url = token_url
+        self.expiry_margin = expiry_margin
+
+        self._tokens = {}
+        self._owners = {}
+        self._lock = threading.RLock()
+
+    def _request_token(self, key, secret):
+        credentials = f'{key}:{secret}'
+        auth = str(base64.b64encode(credentials.encode('utf-8')), "utf-8")
+        headers = {'Authorization': f'Basic {auth}'}
+        data = {'grant_type': 'client_credentials'}
+        r = transport.post(url=self.token_url or transport.get_api_url('v4/token'), headers=headers, data=data)
+
+        try:
+            response = r.json()
+            access_token = response['access_token']
+        except (KeyError, TypeError, JSONDecodeError) as err:
+            logger.info(f"API: Could not receive access token for key {key}. Error message: {err}")
+            return None, None
+
+        try:
+            lifetime = int(response.get('expires_in', DEFAULT_TOKEN_LIFETIME))
+        except (TypeError, ValueError):
+            lifetime = DEFAULT_TOKEN_LIFETIME
+
+        return access_token, monotonic() + max(lifetime - self.expiry_margin, 0)
+
+    def _fetch(self, key, secret):
+        access_token, expires_at = self._request_token(key, secret)
+        if access_token is None:
+            self._tokens.pop((key, secret), None)
+            return None
+
+        self._tokens[(key, secret)] = (access_token, expires_at)
+        self._owners[access_token] = (key, secret)
+        return access_token
+
+    def get_token(self, key, secret):
+        with self._lock:
+            cached = self._tokens.get((key, secret))
+            if cached and cached[1] > monotonic():
+                return cached[0]
+            return self._fetch(key, secret)
+
+    def current(self, access_token):
+        """
+        Returns valid token for the credentials the given token was issued for,
+        or the token itself if it was not issued by this manager.
+        """
+        with self._lock:
+            owner = self._owners.get(access_token)
+        if owner is None:
+            return access_token
+        return self.get_token(*owner) or access_token
+
+    def refresh(self, access_token):
+        """
+        Renews the token after the API rejected it. If another thread already
+        renewed it, the newer token is returned without another round-trip.
+        """
+        with self._lock:
+            owner = self._owners.get(access_token)
+            if owner is None:
+                return None
+
+            cached = self._tokens.get(owner)
+            if cached and cached[0] != access_token and cached[1] > monotonic():
+                return cached[0]
+            return self._fetch(*owner)
+
+    def invalidate(self, key, secret):
+        with self._lock:
+            self._tokens.pop((key, secret), None)
+
+
+token_manager = TokenManager()
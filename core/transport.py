@@ -0,0 +1,139 @@
+import logging
+import re
+import threading
+from time import monotonic
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+logger = logging.getLogger('django')
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 32
+DEFAULT_TIMEOUT = (5, 60)
+
+API_URL = 'https://api.searchmetrics.com'
+GRAPHQL_URL = 'https://graphql.searchmetrics.com'
+
+VERSIONED_PATH_EXP = re.compile(r'(?:(v\d+)/)?([^/]*?)(?:\.json)?$')
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _build_session():
+    """
+    Creates keep-alive session which pools connections per host, so consecutive
+    calls to the same API reuse established TCP/TLS connections.
+    """
+    adapter = HTTPAdapter(
+        pool_connections=getattr(settings, 'SEARCH_METRICS_POOL_CONNECTIONS', DEFAULT_POOL_CONNECTIONS),
+        pool_maxsize=getattr(settings, 'SEARCH_METRICS_POOL_MAXSIZE', DEFAULT_POOL_MAXSIZE),
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def close_session():
+    global _session
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_api_url(path):
+    """
+    Returns url of the Searchmetrics REST endpoint, e.g. get_api_url('v4/token').
+    SEARCH_METRICS_API_URL allows pointing the client to another server.
+    """
+    return getattr(settings, 'SEARCH_METRICS_API_URL', API_URL).rstrip('/') + '/' + path
+
+
+def get_graphql_url():
+    return getattr(settings, 'SEARCH_METRICS_GRAPHQL_URL', GRAPHQL_URL)
+
+
+def get_timeout(endpoint=None):
+    """
+    Returns (connect, read) timeout, SEARCH_METRICS_TIMEOUTS overrides it per endpoint
+    """
+    timeouts = getattr(settings, 'SEARCH_METRICS_TIMEOUTS', {})
+    if endpoint in timeouts:
+        return timeouts[endpoint]
+    return getattr(settings, 'SEARCH_METRICS_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def endpoint_name(url):
+    """
+    Returns name of the endpoint with its API version, e.g. 'v3/ResearchKeywordsGetListKeywordinfo',
+    methods of the same name differ between the versions
+    """
+    if url == get_graphql_url():
+        return 'graphql'
+    return '/'.join(filter(None, VERSIONED_PATH_EXP.search(urlparse(url).path.rstrip('/')).groups()))
+
+
+def error_category(status_code):
+    if status_code == 429:
+        return 'quota'
+    if status_code in (401, 403):
+        return 'auth'
+    if status_code >= 500:
+        return 'server_error'
+    if status_code >= 400:
+        return 'client_error'
+    return None
+
+
+def request(method, url, **kwargs):
+    """
+    Sends request through the shared session and records its latency, size and error category
+    """
+    endpoint = endpoint_name(url)
+    kwargs.setdefault('timeout', get_timeout(endpoint))
+    started = monotonic()
+
+    try:
+        response = get_session().request(method, url, **kwargs)
+    except requests.RequestException as err:
+        metrics.record_call(endpoint, monotonic() - started)
+        if isinstance(err, requests.Timeout):
+            metrics.record_error(endpoint, 'timeout')
+        elif isinstance(err, requests.ConnectionError):
+            metrics.record_error(endpoint, 'connection')
+        else:
+            metrics.record_error(endpoint, 'request_error')
+        raise
+
+    metrics.record_call(endpoint, monotonic() - started, len(response.content))
+    category = error_category(response.status_code)
+    if category:
+        metrics.record_error(endpoint, category)
+    return response
+
+
+def get(url, params=None, **kwargs):
+    return request('GET', url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    return request('POST', url, data=data, json=json, **kwargs)
@@ -1,7 +1,10 @@
 from django.urls import path
 
 from . import views
+from .api import views as api_views
 
 urlpatterns = [
     path('', views.index, name='index'),
+
+    path('api/v1/apiMetrics', api_views.APIMetricsAPI.as_view(), name='APIMetricsAPI'),
 ]
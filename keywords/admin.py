@@ -11,7 +11,7 @@ from .models import DomainData
 @admin.register(DomainData)
 class DomainDataAdmin(ExportCsvMixin, ExportAsURLGroups, ModelAdminTotals):
     search_fields = ['keyword', 'url']
-    list_filter = ('domain', PositionFilter, TrafficIndexFilter, SearchVolumeFilter,
+    list_filter = ('domain', 'country_code', PositionFilter, TrafficIndexFilter, SearchVolumeFilter,
                    TrendFilter, CpcFilter, CompetitionFilter, IntegrationFilter)
     list_totals = [('position', lambda field: Round(Avg(field))), ('affected', lambda field: Round(Avg(field))),
                    ('traffic_index', lambda field: Round(Avg(field))),
@@ -21,7 +21,7 @@ class DomainDataAdmin(ExportCsvMixin, ExportAsURLGroups, ModelAdminTotals):
                    ('competition', lambda field: Round(Avg(field)))]
     actions = ["export_as_csv", "export_as_searchmetrics_csv"]
 
-    list_display = ('url', 'keyword', 'domain', 'position', 'title', 'traffic_index', 'search_volume', 'trend',
-                    'integration', 'cpc', 'competition')
+    list_display = ('url', 'keyword', 'domain', 'country_code', 'position', 'title', 'traffic_index', 'search_volume',
+                    'trend', 'integration', 'cpc', 'competition')
 
 
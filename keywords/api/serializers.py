@@ -1,12 +1,14 @@
 from rest_framework import serializers
 
+from core.helpers import validate_country_codes
+
 
 class DomainSearchMetricsSerializer(serializers.Serializer):
     domain = serializers.CharField(max_length=512)
     key = serializers.CharField(max_length=1024)
     secret = serializers.CharField(max_length=1024)
     amount = serializers.IntegerField()
-    country_code = serializers.CharField(max_length=3)
+    country_code = serializers.CharField(max_length=256, validators=[validate_country_codes])
     analysis_type = serializers.IntegerField()
 
 
@@ -14,13 +16,14 @@ class ExampleKeywordSerializer(serializers.Serializer):
     csv_file = serializers.FileField()
     sort_type = serializers.IntegerField()
     exclude = serializers.CharField(max_length=1024)
+    max_examples = serializers.IntegerField(min_value=1, required=False, allow_null=True)
 
 
 class SearchVolumeSerializer(serializers.Serializer):
     csv_file = serializers.FileField()
     key = serializers.CharField(max_length=1024)
     secret = serializers.CharField(max_length=1024)
-    country_code = serializers.CharField(max_length=3)
+    country_code = serializers.CharField(max_length=256, validators=[validate_country_codes])
 
 
 class KeywordSearchSerializer(serializers.Serializer):
@@ -33,6 +36,10 @@ class SearchVolumeCountSerializer(serializers.Serializer):
     csv_file = serializers.FileField()
     search_limit = serializers.IntegerField()
     exclude = serializers.CharField(max_length=2048)
+    top_n = serializers.IntegerField(min_value=1, required=False, allow_null=True)
+    table_format = serializers.ChoiceField(choices=['csv', 'triplets', 'npz', 'parquet'], required=False)
+    top_words = serializers.IntegerField(min_value=1, required=False, allow_null=True)
+    itemset_size = serializers.IntegerField(min_value=3, max_value=4, required=False, allow_null=True)
 
 
 class TagsBySearchVolumeSerializer(serializers.Serializer):
@@ -43,6 +50,21 @@ class TrafficCountSerializer(serializers.Serializer):
     csv_file = serializers.FileField()
     traffic_limit = serializers.IntegerField()
     exclude = serializers.CharField(max_length=2048)
+    top_n = serializers.IntegerField(min_value=1, required=False, allow_null=True)
+    table_format = serializers.ChoiceField(choices=['csv', 'triplets', 'npz', 'parquet'], required=False)
+    top_words = serializers.IntegerField(min_value=1, required=False, allow_null=True)
+    itemset_size = serializers.IntegerField(min_value=3, max_value=4, required=False, allow_null=True)
+
+
+class CombinedCountSerializer(serializers.Serializer):
+    csv_file = serializers.FileField()
+    count_limit = serializers.IntegerField()
+    traffic_limit = serializers.IntegerField()
+    search_limit = serializers.IntegerField()
+    exclude = serializers.CharField(max_length=2048)
+    top_n = serializers.IntegerField(min_value=1, required=False, allow_null=True)
+    table_format = serializers.ChoiceField(choices=['csv', 'triplets', 'npz', 'parquet'], required=False)
+    top_words = serializers.IntegerField(min_value=1, required=False, allow_null=True)
 
 
 class SearchmetricsToolSerializer(serializers.Serializer):
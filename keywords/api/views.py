@@ -9,11 +9,11 @@ from core.helpers import save_csv_file, get_access_token, get_keywords_phrase
 from .serializers import (CategoryDomainSerializer, DomainSearchMetricsSerializer, ExampleKeywordSerializer,
                           SearchVolumeSerializer, KeywordSearchSerializer, KeywordDomainSerializer,
                           SearchVolumeCountSerializer, TagsBySearchVolumeSerializer, TrafficCountSerializer,
-                          SearchmetricsToolSerializer)
+                          SearchmetricsToolSerializer, CombinedCountSerializer)
 from keywords.core import (KeywordsAnalysis, category_domain_task, get_example_url_keywords, get_group_keywords,
                            run_domain_searchmetrics_complete, run_domain_searchmetrics_simple, search_volume_task,
                            get_keyword_domain, get_similar_keywords, get_tags_by_search_volume, get_url_key_patterns,
-                           get_url_searchmetrics)
+                           get_url_searchmetrics, process_analyses)
 
 
 class CategoryDomainAPI(APIView):
@@ -124,6 +124,7 @@ class ExampleKeywordsAPI(APIView):
 
     Needed query parameters:
         csv_file (file): file of the .csv format with column of keywords
+        max-examples (int): optional, maximum amount of example keywords per combination
     """
     parser_classes = [MultiPartParser]
 
@@ -131,13 +132,15 @@ class ExampleKeywordsAPI(APIView):
         csv_file = request.FILES.get('csv')
         sort_type = request.POST.get('sort')
         exclude = request.POST.get('exclude')
+        max_examples = request.POST.get('max-examples') or None
 
         serializer = ExampleKeywordSerializer(
             data=
             {
                 'csv_file': csv_file,
                 'sort_type': int(sort_type),
-                'exclude': exclude
+                'exclude': exclude,
+                'max_examples': max_examples
             }
         )
 
@@ -165,7 +168,8 @@ class ExampleKeywordsAPI(APIView):
         analysis.process_words_dict()
         analysis.sort()
 
-        filename = analysis.save(table=False, example_keywords=True)
+        filename = analysis.save(table=False, example_keywords=True,
+                                 max_examples=serializer.validated_data.get('max_examples'))
         return Response({'filename': filename}, status=HTTP_200_OK)
 
 
@@ -364,6 +368,10 @@ class SearchCountAPI(APIView):
 
     Needed query parameters:
         csv_file (file): file of the .csv format with column of keywords
+        top-n (int): optional, amount of the highest combinations in the list file
+        table-format (str): optional, csv (dense matrix, default), triplets, npz or parquet
+        top-words (int): optional, amount of the highest words in the table
+        itemset-size (int): optional, 3 or 4, also ranks combinations of up to this many words
     """
     parser_classes = [MultiPartParser]
 
@@ -371,12 +379,20 @@ class SearchCountAPI(APIView):
         csv_file = request.FILES.get('csv')
         search_limit = int(request.POST.get('search-limit'))
         exclude = request.POST.get('exclude')
+        top_n = request.POST.get('top-n') or None
+        table_format = request.POST.get('table-format') or 'csv'
+        top_words = request.POST.get('top-words') or None
+        itemset_size = request.POST.get('itemset-size') or None
 
         serializer = SearchVolumeCountSerializer(
             data={
                 'csv_file': csv_file,
                 'search_limit': search_limit,
-                'exclude': exclude
+                'exclude': exclude,
+                'top_n': top_n,
+                'table_format': table_format,
+                'top_words': top_words,
+                'itemset_size': itemset_size
             }
         )
 
@@ -392,20 +408,22 @@ class SearchCountAPI(APIView):
             analysis="search",
             limit=search_limit
         )
-        analysis.set_df()
-        analysis.process_words_dict()
+        analysis.process_file()
         analysis.sort()
 
-        filename = analysis.save(table=True)
-        list_filename = analysis.save(table=False)
+        filename = analysis.save(table=True, table_format=table_format,
+                                 top_words=serializer.validated_data.get('top_words'))
+        list_filename = analysis.save(table=False, top_n=serializer.validated_data.get('top_n'))
 
-        return Response(
-            {
-                'filename': filename,
-                'list_filename': list_filename
-            },
-            status=HTTP_200_OK
-        )
+        response = {
+            'filename': filename,
+            'list_filename': list_filename
+        }
+        if serializer.validated_data.get('itemset_size'):
+            analysis.process_itemsets(serializer.validated_data['itemset_size'])
+            response['itemsets_filename'] = analysis.save_itemsets(top_n=serializer.validated_data.get('top_n'))
+
+        return Response(response, status=HTTP_200_OK)
 
 
 class SimilarKeywordsAPI(APIView):
@@ -499,6 +517,10 @@ class TrafficCountAPI(APIView):
 
     Needed query parameters:
         csv_file (file): file of the .csv format with column of keywords
+        top-n (int): optional, amount of the highest combinations in the list file
+        table-format (str): optional, csv (dense matrix, default), triplets, npz or parquet
+        top-words (int): optional, amount of the highest words in the table
+        itemset-size (int): optional, 3 or 4, also ranks combinations of up to this many words
     """
     parser_classes = [MultiPartParser]
 
@@ -506,13 +528,21 @@ class TrafficCountAPI(APIView):
         csv_file = request.FILES.get('csv')
         traffic_limit = int(request.POST.get('traffic-limit'))
         exclude = request.POST.get('exclude')
+        top_n = request.POST.get('top-n') or None
+        table_format = request.POST.get('table-format') or 'csv'
+        top_words = request.POST.get('top-words') or None
+        itemset_size = request.POST.get('itemset-size') or None
 
         serializer = TrafficCountSerializer(
             data=
             {
                 'csv_file': csv_file,
                 'traffic_limit': traffic_limit,
-                'exclude': exclude
+                'exclude': exclude,
+                'top_n': top_n,
+                'table_format': table_format,
+                'top_words': top_words,
+                'itemset_size': itemset_size
             }
         )
 
@@ -528,20 +558,22 @@ class TrafficCountAPI(APIView):
             analysis="traffic",
             limit=traffic_limit
         )
-        analysis.set_df()
-        analysis.process_words_dict()
+        analysis.process_file()
         analysis.sort()
 
-        filename = analysis.save(table=True)
-        list_filename = analysis.save(table=False)
+        filename = analysis.save(table=True, table_format=table_format,
+                                 top_words=serializer.validated_data.get('top_words'))
+        list_filename = analysis.save(table=False, top_n=serializer.validated_data.get('top_n'))
 
-        return Response(
-            {
-                'filename': filename,
-                'list_filename': list_filename
-            },
-            status=HTTP_200_OK
-        )
+        response = {
+            'filename': filename,
+            'list_filename': list_filename
+        }
+        if serializer.validated_data.get('itemset_size'):
+            analysis.process_itemsets(serializer.validated_data['itemset_size'])
+            response['itemsets_filename'] = analysis.save_itemsets(top_n=serializer.validated_data.get('top_n'))
+
+        return Response(response, status=HTTP_200_OK)
 
 
 class KeyPatternExtractionAPI(APIView):
@@ -626,6 +658,10 @@ class WordsCountAPI(APIView):
 
     Needed query parameters:
         csv_file (file): file of the .csv format with column of keywords
+        top-n (int): optional, amount of the highest combinations in the list file
+        table-format (str): optional, csv (dense matrix, default), triplets, npz or parquet
+        top-words (int): optional, amount of the highest words in the table
+        itemset-size (int): optional, 3 or 4, also ranks combinations of up to this many words
     """
     parser_classes = [MultiPartParser]
 
@@ -633,13 +669,21 @@ class WordsCountAPI(APIView):
         csv_file = request.FILES.get('csv')
         count_limit = int(request.POST.get('count-limit'))
         exclude = request.POST.get('exclude')
+        top_n = request.POST.get('top-n') or None
+        table_format = request.POST.get('table-format') or 'csv'
+        top_words = request.POST.get('top-words') or None
+        itemset_size = request.POST.get('itemset-size') or None
 
         serializer = TrafficCountSerializer(
             data=
             {
                 'csv_file': csv_file,
                 'traffic_limit': count_limit,
-                'exclude': exclude
+                'exclude': exclude,
+                'top_n': top_n,
+                'table_format': table_format,
+                'top_words': top_words,
+                'itemset_size': itemset_size
             }
         )
 
@@ -655,18 +699,88 @@ class WordsCountAPI(APIView):
             analysis="count",
             limit=count_limit
         )
-        analysis.set_df()
-        analysis.process_words_dict()
+        analysis.process_file()
         analysis.sort()
 
-        filename = analysis.save(table=True)
-        list_filename = analysis.save(table=False)
+        filename = analysis.save(table=True, table_format=table_format,
+                                 top_words=serializer.validated_data.get('top_words'))
+        list_filename = analysis.save(table=False, top_n=serializer.validated_data.get('top_n'))
 
-        return Response(
+        response = {
+            'filename': filename,
+            'list_filename': list_filename
+        }
+        if serializer.validated_data.get('itemset_size'):
+            analysis.process_itemsets(serializer.validated_data['itemset_size'])
+            response['itemsets_filename'] = analysis.save_itemsets(top_n=serializer.validated_data.get('top_n'))
+
+        return Response(response, status=HTTP_200_OK)
+
+
+class CombinedCountAPI(APIView):
+    """
+    API Class for getting words combinations count, traffic index and search volume of the keywords
+    at once, the file is read and its keywords are split into words a single time for all three
+
+    Needed query parameters:
+        csv_file (file): file of the .csv format with columns Keyword, Traffic Index and Search Volume
+        count-limit (int), traffic-limit (int), search-limit (int): limits of the three analyses
+        top-n (int): optional, amount of the highest combinations in the list files
+        table-format (str): optional, csv (dense matrix, default), triplets, npz or parquet
+        top-words (int): optional, amount of the highest words in the tables
+    """
+    parser_classes = [MultiPartParser]
+
+    def put(self, request, *args, **kwargs):
+        csv_file = request.FILES.get('csv')
+        limits = {
+            'count': int(request.POST.get('count-limit')),
+            'traffic': int(request.POST.get('traffic-limit')),
+            'search': int(request.POST.get('search-limit'))
+        }
+        exclude = request.POST.get('exclude')
+        top_n = request.POST.get('top-n') or None
+        table_format = request.POST.get('table-format') or 'csv'
+        top_words = request.POST.get('top-words') or None
+
+        serializer = CombinedCountSerializer(
+            data=
             {
-                'filename': filename,
-                'list_filename': list_filename
-            },
-            status=HTTP_200_OK
+                'csv_file': csv_file,
+                'count_limit': limits['count'],
+                'traffic_limit': limits['traffic'],
+                'search_limit': limits['search'],
+                'exclude': exclude,
+                'top_n': top_n,
+                'table_format': table_format,
+                'top_words': top_words
+            }
         )
 
+        if not serializer.is_valid():
+            return Response(serializer.error_messages,
+                            status=HTTP_406_NOT_ACCEPTABLE)
+
+        exclude_inner = exclude.split()
+        analyses = {
+            name: KeywordsAnalysis(
+                csv_file=csv_file,
+                filename=name,
+                exclude_words=exclude_inner,
+                analysis=name,
+                limit=limit
+            )
+            for name, limit in limits.items()
+        }
+        process_analyses(list(analyses.values()), csv_file)
+
+        response = {}
+        for name, analysis in analyses.items():
+            analysis.sort()
+            response[name] = {
+                'filename': analysis.save(table=True, table_format=table_format,
+                                          top_words=serializer.validated_data.get('top_words')),
+                'list_filename': analysis.save(table=False, top_n=serializer.validated_data.get('top_n'))
+            }
+
+        return Response(response, status=HTTP_200_OK)
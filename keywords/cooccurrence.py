@@ -0,0 +1,386 @@
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import re
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def is_cached_char(word):
+    """
+    Single latin-1 characters split from a keyword are the same object, a repeated one
+    was never paired with itself by the former dict based counting
+    """
+    return len(word) == 1 and ord(word) < 256
+
+
+def inverted_index(keywords, words=None):
+    """
+    Returns ascending positions of the keywords containing each word, only of words if given
+    """
+    tokens = pd.Series(list(keywords), dtype=object).str.split().explode().dropna()
+    if words is not None:
+        tokens = tokens[tokens.isin(words)]
+
+    postings = pd.DataFrame({'word': tokens.to_numpy(dtype=object), 'row': tokens.index.to_numpy(dtype=np.int64)})
+    postings = postings.drop_duplicates()
+    return {word: rows.to_numpy() for word, rows in postings.groupby('word', sort=False)['row']}
+
+
+def lookup(index, words):
+    """
+    Returns ascending positions of the keywords containing all of words
+    """
+    rows = None
+    for word in words:
+        postings = index.get(word)
+        if postings is None:
+            return np.zeros(0, dtype=np.int64)
+        rows = postings if rows is None else np.intersect1d(rows, postings, assume_unique=True)
+    return rows
+
+
+class WordFilter:
+    """
+    Picklable predicate of the tokens counted as words of a keyword
+
+    Attributes:
+        exclude_matcher (SubstringMatcher): tokens containing any of its words are skipped
+        stop_words (collection): tokens skipped as a whole
+        pattern (str): regex the tokens have to start with
+    """
+    def __init__(self, exclude_matcher, stop_words=(), pattern=None):
+        self.exclude_matcher = exclude_matcher
+        self.stop_words = stop_words
+        self.pattern = re.compile(pattern) if pattern is not None else None
+
+    def __call__(self, token):
+        if self.exclude_matcher.search(token) or token in self.stop_words:
+            return False
+        return self.pattern is None or self.pattern.match(token) is not None
+
+
+class CooccurrenceMatrix:
+    """
+    Weighted co-occurrence of the words of keywords as a sparse matrix. Each keyword adds
+    its weight times the occurrences of both words to every pair of its words and its
+    weight times the squared occurrences to the diagonal entry of a word.
+
+    Attributes:
+        words (list): vocabulary in the order of the first occurrence
+        index (dict): id of every word
+        values (csr_matrix): summed weights, an entry is stored for every pair of words seen
+            together, also when the sum is zero
+    """
+    def __init__(self, words, values):
+        self.words = words
+        self.index = {word: word_id for word_id, word in enumerate(words)}
+        self.values = values
+
+    @classmethod
+    def from_keywords(cls, keywords, weights=None, is_word=None):
+        """
+        Args:
+            keywords (iterable): keyword phrases, words are separated by whitespace
+            weights (iterable): weight of every keyword, 1 by default
+            is_word (callable): predicate of the tokens counted as words, called once per distinct token
+        """
+        counter = CooccurrenceCounter(is_word=is_word)
+        counter.add(keywords, weights)
+        return counter.matrix()
+
+    def diagonal(self):
+        return self.values.diagonal()
+
+    def row_max(self):
+        """
+        Returns the highest value stored in the row of every word
+        """
+        if not len(self.words):
+            return self.values.data[:0]
+        return np.maximum.reduceat(self.values.data, self.values.indptr[:-1])
+
+    def pairs(self, words, limit, top_n=None):
+        """
+        Returns ('first second', value) of the pairs of words seen together with value of at
+        least limit, ordered by the position of the first and then of the second word in words.
+        With top_n only the top_n highest pairs are returned, ordered by value and then by position.
+        """
+        ids = np.array([self.index[word] for word in words], dtype=np.int64)
+        position = np.full(len(self.words), -1, dtype=np.int64)
+        position[ids] = np.arange(len(ids))
+
+        matrix = self.values.tocoo()
+        first, second = position[matrix.row], position[matrix.col]
+        mask = (first >= 0) & (first < second) & (matrix.data >= limit)
+        first, second, data = first[mask], second[mask], matrix.data[mask]
+
+        if top_n is not None and len(data) > top_n:
+            # Only pairs reaching the top_n-th highest value can make it, ties are cut by position below
+            threshold = np.partition(data, len(data) - top_n)[len(data) - top_n]
+            candidates = data >= threshold
+            first, second, data = first[candidates], second[candidates], data[candidates]
+
+        order = np.lexsort((second, first))
+        if top_n is not None:
+            order = order[np.argsort(-data[order], kind='stable')[:top_n]]
+        return [(f'{words[first[i]]} {words[second[i]]}', data[i]) for i in order]
+
+    def submatrix(self, words):
+        """
+        Returns csr matrix of the values among words, rows and columns in the order of words
+        """
+        ids = np.array([self.index[word] for word in words], dtype=np.int64)
+        position = np.full(len(self.words), -1, dtype=np.int64)
+        position[ids] = np.arange(len(ids))
+
+        matrix = self.values.tocoo()
+        row, col = position[matrix.row], position[matrix.col]
+        mask = (row >= 0) & (col >= 0)
+        submatrix = sparse.coo_matrix((matrix.data[mask], (row[mask], col[mask])), shape=(len(ids), len(ids))).tocsr()
+        submatrix.sort_indices()
+        return submatrix
+
+    def to_frame(self, words):
+        """
+        Returns DataFrame of the stored values among words as (Word 1, Word 2, Value) rows
+        """
+        matrix = self.submatrix(words).tocoo()
+        words = np.array(words, dtype=object)
+        return pd.DataFrame({'Word 1': words[matrix.row], 'Word 2': words[matrix.col], 'Value': matrix.data})
+
+    def save_npz(self, file, words):
+        """
+        Saves the values among words in the format of scipy.sparse.save_npz with the words
+        as an additional array, so the file can be read with scipy.sparse.load_npz
+        """
+        matrix = self.submatrix(words)
+        np.savez_compressed(file, format='csr', shape=matrix.shape, data=matrix.data, indices=matrix.indices,
+                            indptr=matrix.indptr, words=np.array(words, dtype=str))
+
+    def rows(self, words):
+        """
+        Yields for every word its values with each of words, None where they were never seen together
+        """
+        ids = np.array([self.index[word] for word in words], dtype=np.int64)
+        position = np.full(len(self.words), -1, dtype=np.int64)
+        position[ids] = np.arange(len(ids))
+
+        indptr, indices, data = self.values.indptr, self.values.indices, self.values.data
+        for word_id in ids:
+            columns = position[indices[indptr[word_id]:indptr[word_id + 1]]]
+            values = data[indptr[word_id]:indptr[word_id + 1]]
+            row = [None] * len(ids)
+            for column, value in zip(columns[columns >= 0], values[columns >= 0]):
+                row[column] = value
+            yield row
+
+
+def _pad(matrix, size):
+    """
+    Returns square csr matrix grown to size, new rows and columns are empty
+    """
+    indptr = np.concatenate([matrix.indptr, np.full(size - matrix.shape[0], matrix.indptr[-1])])
+    return sparse.csr_matrix((matrix.data, matrix.indices, indptr), shape=(size, size))
+
+
+Tokens = namedtuple('Tokens', ['rows', 'word_ids', 'words', 'size'])
+Shard = namedtuple('Shard', ['words', 'present', 'totals', 'linear'])
+
+
+def tokenize(keywords, is_word=None):
+    """
+    Splits keywords into words and maps them to ids in the order of the first occurrence
+
+    Args:
+        keywords (iterable): keyword phrases, words are separated by whitespace
+        is_word (callable): predicate of the tokens counted as words, called once per distinct token
+
+    Returns:
+        Tokens of the keyword row and the word id of every word, the words and the amount of keywords
+    """
+    keywords = pd.Series(list(keywords), dtype=object)
+    tokens = keywords.str.split().explode().dropna()
+    if is_word is not None and len(tokens):
+        qualified = {token: bool(is_word(token)) for token in tokens.unique()}
+        tokens = tokens[tokens.map(qualified).to_numpy(dtype=bool)]
+
+    word_ids, words = pd.factorize(tokens.to_numpy(dtype=object))
+    return Tokens(rows=tokens.index.to_numpy(dtype=np.int64), word_ids=word_ids.astype(np.int64),
+                  words=list(words), size=len(keywords))
+
+
+def count_tokens(tokens, weights=None, selected=None):
+    """
+    Counts the pairs of words of tokenized keywords with ids local to the shard, the weighted
+    pairs are summed as the product of the keyword-word matrix with its weighted copy.
+
+    Args:
+        tokens (Tokens): tokenized keywords
+        weights (iterable): weight of every keyword, 1 by default
+        selected (array): mask of the keywords counted, all by default
+
+    Returns:
+        Shard of the words in the order of the first occurrence, pairs seen together,
+        summed weights and the weights summed once per occurrence of every word
+    """
+    if weights is None:
+        weights = np.ones(tokens.size, dtype=np.int64)
+    weights = np.asarray(weights)
+
+    rows, word_ids, words = tokens.rows, tokens.word_ids, tokens.words
+    if selected is not None:
+        kept = np.asarray(selected, dtype=bool)[rows]
+        # Words only seen in keywords left out do not belong to the vocabulary
+        word_ids, first = pd.factorize(word_ids[kept])
+        rows, words = rows[kept], [words[word_id] for word_id in first]
+
+    shape = (tokens.size, len(words))
+    counts = sparse.csr_matrix((np.ones(len(word_ids), dtype=np.int64), (rows, word_ids)), shape=shape)
+    counts.sum_duplicates()
+    weighted = sparse.csr_matrix(
+        (counts.data * np.repeat(weights, np.diff(counts.indptr)), counts.indices, counts.indptr),
+        shape=shape
+    )
+    pattern = sparse.csr_matrix((np.ones_like(counts.data), counts.indices, counts.indptr), shape=shape)
+
+    return Shard(
+        words=list(words),
+        present=(pattern.T.tocsr() @ pattern).tocsr(),
+        totals=(counts.T.tocsr() @ weighted).tocsr(),
+        linear=weighted.T.tocsr() @ np.ones(tokens.size, dtype=weighted.dtype)
+    )
+
+
+def count_shard(keywords, weights=None, is_word=None):
+    """
+    Counts the pairs of words of keywords with ids local to the shard, see count_tokens
+    """
+    return count_tokens(tokenize(keywords, is_word), weights)
+
+
+def count_weightings(keywords, weightings, is_word=None):
+    """
+    Tokenizes keywords once and counts a shard for each of (weights, selected) weightings
+    """
+    tokens = tokenize(keywords, is_word)
+    return [count_tokens(tokens, weights, selected) for weights, selected in weightings]
+
+
+def count_chunks(chunks, counters, processes=1):
+    """
+    Counts (keywords, weightings) chunks into counters, one (weights, selected) weighting per
+    counter, so every chunk is tokenized once for all counters. The counters have to share
+    their is_word predicate. With more than one process the chunks are counted in a pool and
+    merged in order, at most two chunks per process are read ahead.
+    """
+    def merge(shards):
+        for counter, shard in zip(counters, shards):
+            counter.merge(shard)
+
+    first = counters[0]
+    if processes == 1:
+        is_word = first._is_word if first.is_word is not None else None
+        for keywords, weightings in chunks:
+            merge(count_weightings(keywords, weightings, is_word))
+        return
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque()
+        for keywords, weightings in chunks:
+            pending.append(executor.submit(count_weightings, keywords, weightings, first.is_word))
+            if len(pending) >= processes * 2:
+                merge(pending.popleft().result())
+        while pending:
+            merge(pending.popleft().result())
+
+
+class CooccurrenceCounter:
+    """
+    Builds CooccurrenceMatrix from keywords added in chunks or counted as shards in a process
+    pool. The shards are merged in their order, so both give the same matrix for the same
+    chunks. Memory is bounded by the vocabulary and its pairs, not by the amount of keywords.
+
+    Attributes:
+        is_word (callable): predicate of the tokens counted as words, called once per distinct token,
+            it has to be picklable for the process pool
+        words (list): vocabulary in the order of the first occurrence
+    """
+    def __init__(self, is_word=None):
+        self.is_word = is_word
+        self.words = []
+
+        self._index = {}
+        self._qualified = {}
+        self._present = None
+        self._totals = None
+        self._linear = None
+
+    def _is_word(self, token):
+        qualified = self._qualified.get(token)
+        if qualified is None:
+            qualified = self._qualified[token] = bool(self.is_word(token))
+        return qualified
+
+    def add(self, keywords, weights=None):
+        """
+        Args:
+            keywords (iterable): keyword phrases, words are separated by whitespace
+            weights (iterable): weight of every keyword, 1 by default
+        """
+        self.merge(count_shard(keywords, weights, is_word=self._is_word if self.is_word is not None else None))
+
+    def add_shards(self, shards, processes):
+        """
+        Counts (keywords, weights) shards in a pool of processes and merges them in order
+        """
+        count_chunks(((keywords, [(weights, None)]) for keywords, weights in shards), [self], processes)
+
+    def merge(self, shard):
+        """
+        Adds counts of a shard, its new words are appended to the vocabulary
+        """
+        for word in shard.words:
+            if word not in self._index:
+                self._index[word] = len(self.words)
+                self.words.append(word)
+        ids = np.array([self._index[word] for word in shard.words], dtype=np.int64)
+
+        size = len(self.words)
+        present, totals = shard.present.tocoo(), shard.totals.tocoo()
+        present = sparse.csr_matrix((present.data, (ids[present.row], ids[present.col])), shape=(size, size))
+        totals = sparse.csr_matrix((totals.data, (ids[totals.row], ids[totals.col])), shape=(size, size))
+        linear = np.zeros(size, dtype=shard.linear.dtype)
+        linear[ids] = shard.linear
+
+        if self._present is None:
+            self._present, self._totals, self._linear = present, totals, linear
+        else:
+            self._present = _pad(self._present, size) + present
+            self._totals = _pad(self._totals, size) + totals
+            self._linear = np.concatenate([self._linear, np.zeros(size - len(self._linear), self._linear.dtype)]) \
+                + linear
+
+    def matrix(self):
+        """
+        Returns CooccurrenceMatrix of the keywords added so far
+        """
+        if self._present is None:
+            self.add([])
+
+        present = self._present
+        present.sort_indices()
+        rows = np.repeat(np.arange(len(self.words)), np.diff(present.indptr))
+        if len(rows):
+            data = np.asarray(self._totals[rows, present.indices]).ravel().astype(self._totals.dtype)
+        else:
+            data = np.zeros(0, dtype=self._totals.dtype)
+
+        cached = np.array([is_cached_char(word) for word in self.words], dtype=bool)
+        if cached.any():
+            diagonal = (rows == present.indices) & cached[rows]
+            data[diagonal] = self._linear[rows[diagonal]]
+
+        values = sparse.csr_matrix((data, present.indices, present.indptr), shape=(len(self.words), len(self.words)))
+        return CooccurrenceMatrix(list(self.words), values)
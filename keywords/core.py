@@ -1,5 +1,6 @@
 import csv
 from datetime import datetime
+from itertools import chain
 from json import JSONDecodeError
 import logging
 from operator import itemgetter
@@ -12,18 +13,28 @@ from urllib.parse import parse_qs
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from django.core.mail import EmailMessage
+from django.db import DatabaseError
 
 from background_task import background
 import pandas as pd
-import requests
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.decomposition import LatentDirichletAllocation
 
+from keywords.cooccurrence import (CooccurrenceCounter, CooccurrenceMatrix, WordFilter, count_chunks, inverted_index,
+                                   lookup)
+from keywords.itemsets import ItemsetMiner
 from keywords.models import DomainData
-from core.searchmetrics import SearchmetricsAPI
-from core.helpers import (generate_random_number, add_to_dictionary, get_rankings_data, filtered_array,
+from core.searchmetrics import SearchmetricsAPI, api_request
+from core.transport import get_api_url
+from core.batch import iter_pages, run_batch
+from core.circuit import CircuitOpenError
+from core.matcher import SubstringMatcher
+from core.planner import RequestPlan
+from core.records import HistoricRanking, KeywordInfo, KeywordRanking, decode
+from core.helpers import (generate_random_number, add_to_dictionary, get_rankings_page, filtered_array,
                           average, get_access_token, get_keyword_info, get_domain, generate_directories,
-                          get_keyword_data, send_mail, is_included, top_words, get_subdomain, get_list_rankings)
+                          get_keyword_data, send_mail, is_included, top_words, get_subdomain, get_list_rankings,
+                          get_keyword_volume, parse_country_codes)
 
 logger = logging.getLogger('django')
 
@@ -53,6 +64,10 @@ CATEGORY_NAMES = {
 
 N_SAMPLES, N_FEATURES, N_COMPONENTS, N_TOP_WORDS = 20000, 20000, 1, 5
 
+CSV_CHUNK_SIZE = 100000
+
+TABLE_FORMATS = {'csv': 'csv', 'triplets': 'csv', 'npz': 'npz', 'parquet': 'parquet'}
+
 tf_vectorizer = CountVectorizer(max_df=1.0, min_df=.0,
                                 ngram_range=(1, 2),
                                 token_pattern=r'\b[\w-]+\b',
@@ -84,9 +99,15 @@ class KeywordsAnalysis:
         self.filename = filename
         self.analysis = analysis
         self.exclude_words = exclude_words
+        self.exclude_matcher = SubstringMatcher(exclude_words)
+        # Stop words are only skipped without own exclude words
+        self.word_filter = WordFilter(self.exclude_matcher, stop_words=() if exclude_words else EXCLUDE_WORDS,
+                                      pattern=WORD_REG_EXP)
         self.limit = limit
 
-        self.words_dict = {}
+        self.matrix = None
+        self.itemsets = None
+        self.keyword_index = None
         self.sorted_dict = {}
         self.sorted_list = []
         self.temp_file = None
@@ -109,72 +130,69 @@ class KeywordsAnalysis:
         return fs.url(filename)
 
     def is_not_included(self, word, inner_only=False):
-        for exclude_word in self.exclude_words:
-            if word.lower().find(exclude_word.lower()) != -1:
-                return False
-        return True and (inner_only or word not in EXCLUDE_WORDS)
+        return not self.exclude_matcher.search(word) and (inner_only or word not in EXCLUDE_WORDS)
+
+    def _weighting(self, df):
+        """
+        Returns weights of the rows of the analysis and the mask of the rows reaching its limit
+        """
+        if self.analysis == 'count':
+            return None, None
+
+        column = 'Traffic Index' if self.analysis == 'traffic' else 'Search Volume'
+        weights = df[column].to_numpy()
+        return weights, weights >= self.limit
+
+    def _select(self, df):
+        """
+        Returns keywords of the rows reaching the limit of the analysis with their weights
+        """
+        weights, selected = self._weighting(df)
+        if selected is None:
+            return df['Keyword'], weights
+        return df['Keyword'].to_numpy()[selected], weights[selected]
 
     def process_words_dict(self):
-        keywords = self.df['Keyword']
-        traffic_index = self.df['Traffic Index'] if 'Traffic Index' in self.df.columns else None
-        search_volume = self.df['Search Volume'] if 'Search Volume' in self.df.columns else None
-        value = {'count': 1}
-
-        for index, keyword in enumerate(keywords):
-            if traffic_index is not None:
-                value['traffic'] = traffic_index[index]
-            if search_volume is not None:
-                value['search'] = search_volume[index]
-
-            temp_words = []
-            words = keyword.split()
-
-            if self.analysis is 'count' or value[self.analysis] >= self.limit:
-                for word in words:
-                    if self.is_not_included(word, self.exclude_words) and re.match(WORD_REG_EXP, word):
-                        temp_words.append(word)
-                        if word not in self.words_dict.keys():
-                            self.words_dict[word] = {word: value[self.analysis]}
-                        else:
-                            self.words_dict[word][word] += value[self.analysis]
-
-            for temp_word in temp_words:
-                for word in temp_words:
-                    if word is not temp_word:
-                        try:
-                            self.words_dict[temp_word][word] += value[self.analysis]
-                        except KeyError:
-                            self.words_dict[temp_word][word] = value[self.analysis]
+        keywords, weights = self._select(self.df)
+        self.matrix = CooccurrenceMatrix.from_keywords(keywords, weights, is_word=self.word_filter)
+        self.keyword_index = inverted_index(self.df['Keyword'], self.matrix.words)
+
+    def process_file(self, chunk_size=None, processes=None):
+        """
+        Reads the uploaded csv file in chunks straight into the co-occurrence counter,
+        the rows are not kept, so saving example keywords is not available afterwards.
+        See process_analyses.
+        """
+        process_analyses([self], self.csv_file, chunk_size=chunk_size, processes=processes)
+
+    def process_itemsets(self, max_size, chunk_size=None):
+        """
+        Mines the sets of up to max_size words found together in the keywords of the uploaded
+        csv file with the limit as minimum support, every size reads the file once more
+        """
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'KEYWORDS_CSV_CHUNK_SIZE', CSV_CHUNK_SIZE)
+
+        def read_chunks():
+            self.csv_file.seek(0)
+            for chunk in pd.read_csv(self.csv_file, chunksize=chunk_size, dtype={'Keyword': str}):
+                weights, selected = self._weighting(chunk)
+                yield chunk['Keyword'].to_numpy(), weights, selected
+
+        self.itemsets = ItemsetMiner(self.limit, is_word=self.word_filter).mine(read_chunks, max_size)
 
     def _prepare_count_sort(self):
-        for word in self.words_dict.keys():
-            if self.words_dict[word][word] >= self.limit:
-                self.sorted_dict[word] = self.words_dict[word][word]
+        for word, value in zip(self.matrix.words, self.matrix.diagonal()):
+            if value >= self.limit:
+                self.sorted_dict[word] = value
 
     def _prepare_sort(self):
-        for word in self.words_dict.keys():
-            max_traffic = -1
-            max_key = 0
-            for word_key in self.words_dict[word].keys():
-                if self.words_dict[word][word_key] > max_traffic:
-                    max_traffic = self.words_dict[word][word_key]
-                    max_key = word_key
-            try:
-                self.sorted_dict[word] = self.words_dict[word][max_key]
-            except KeyError:
-                pass
+        for word, value in zip(self.matrix.words, self.matrix.row_max()):
+            if value > -1:
+                self.sorted_dict[word] = value
 
-    def _get_sorted_list(self, example_keywords=False):
-        sorted_list = {}
-        for word in self.sorted_list:
-            for row_word in self.sorted_list:
-                if word is not row_word:
-                    try:
-                        if self.words_dict[row_word][word] >= self.limit:
-                            if f'{row_word} {word}' not in sorted_list.keys():
-                                sorted_list[f'{word} {row_word}'] = self.words_dict[row_word][word]
-                    except KeyError:
-                        pass
+    def _get_sorted_list(self, example_keywords=False, top_n=None):
+        sorted_list = dict(self.matrix.pairs(self.sorted_list, self.limit, top_n=top_n))
 
         if example_keywords:
             sorted_list = [key for key, _ in sorted(sorted_list.items(),
@@ -194,7 +212,29 @@ class KeywordsAnalysis:
 
         self.sorted_list = [key for key, _ in sorted(self.sorted_dict.items(), key=itemgetter(1), reverse=True)]
 
-    def save(self, table=False, example_keywords=False):
+    def save_table(self, table_format='triplets', top_words=None):
+        """
+        Saves the co-occurrence table of the top_words highest words, all words by default, as
+        sparse (Word 1, Word 2, Value) rows in csv ('triplets') or parquet format, or as npz
+        matrix readable with scipy.sparse.load_npz
+        """
+        words = self.sorted_list[:top_words]
+        filename = f"{self.filename}_{generate_random_number()}.{TABLE_FORMATS[table_format]}"
+        filepath = f"{settings.REPORT_PATH}/{filename}"
+
+        if table_format == 'npz':
+            self.matrix.save_npz(filepath, words)
+        elif table_format == 'parquet':
+            self.matrix.to_frame(words).to_parquet(filepath, index=False)
+        else:
+            self.matrix.to_frame(words).to_csv(filepath, index=False, encoding='utf-8')
+        return filename
+
+    def save(self, table=False, example_keywords=False, top_n=None, max_examples=None, table_format='csv',
+             top_words=None):
+        if table and table_format != 'csv':
+            return self.save_table(table_format, top_words)
+
         filename = f"{self.filename}_{generate_random_number()}.csv"
         filepath = f"{settings.REPORT_PATH}/{filename}"
 
@@ -202,41 +242,94 @@ class KeywordsAnalysis:
             writer = csv.writer(f)
 
             if table:
-                writer.writerow([None] + self.sorted_list)
-
-                for word in self.sorted_list:
-                    row = [word]
-                    for row_word in self.sorted_list:
-                        try:
-                            row.append(self.words_dict[row_word][word])
-                        except KeyError:
-                            row.append("-")
-                    writer.writerow(row)
+                words = self.sorted_list[:top_words]
+                writer.writerow([None] + words)
+
+                for word, values in zip(words, self.matrix.rows(words)):
+                    writer.writerow([word] + ["-" if value is None else value for value in values])
             else:
                 if not example_keywords:
                     writer.writerow(['Combinations', 'Count'])
                 else:
                     writer.writerow(['-' for _ in range(25)])
 
-                sorted_list = self._get_sorted_list(example_keywords)
+                sorted_list = self._get_sorted_list(example_keywords, top_n=top_n)
+                keywords = self.df['Keyword'].to_numpy() if example_keywords else None
                 for word in sorted_list:
                     if example_keywords:
-                        row = [word]
-                        for words in self.df['Keyword']:
-                            if all(elem in words.split() for elem in word.split()):
-                                row.append(words)
-                        writer.writerow(row)
+                        rows = lookup(self.keyword_index, word.split())[:max_examples]
+                        writer.writerow([word] + list(keywords[rows]))
                     else:
                         writer.writerow(word)
         return filename
 
+    def save_itemsets(self, min_size=3, top_n=None):
+        """
+        Saves the mined sets of at least min_size words ranked by their support
+        """
+        filename = f"{self.filename}_itemsets_{generate_random_number()}.csv"
+        filepath = f"{settings.REPORT_PATH}/{filename}"
+
+        with open(filepath, 'w+', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Combinations', 'Count'])
+            for itemset in self.itemsets.itemsets(min_size=min_size, top_n=top_n):
+                writer.writerow(itemset)
+        return filename
+
+
+def process_analyses(analyses, csv_file, chunk_size=None, processes=None):
+    """
+    Counts several analyses of the same uploaded csv file, e.g. count, traffic and search volume,
+    reading and tokenizing every chunk of the file once for all of them. With more than one process
+    files of more than one chunk are counted in a pool, the result is the same as counting the
+    chunks one after another.
+
+    Args:
+        analyses (list): KeywordsAnalysis sharing their exclude words
+        csv_file (file): file of the .csv format
+        chunk_size (int): rows read at once, KEYWORDS_CSV_CHUNK_SIZE by default
+        processes (int): size of the process pool, KEYWORDS_PROCESSES or 1 (no pool) by default
+    """
+    if any(analysis.exclude_words != analyses[0].exclude_words for analysis in analyses):
+        raise ValueError('Analyses of one file have to share their exclude words')
+
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'KEYWORDS_CSV_CHUNK_SIZE', CSV_CHUNK_SIZE)
+    if processes is None:
+        processes = getattr(settings, 'KEYWORDS_PROCESSES', 1)
+
+    csv_file.seek(0)
+    chunks = ((chunk['Keyword'].to_numpy(), [analysis._weighting(chunk) for analysis in analyses])
+              for chunk in pd.read_csv(csv_file, chunksize=chunk_size, dtype={'Keyword': str}))
+
+    counters = [CooccurrenceCounter(is_word=analysis.word_filter) for analysis in analyses]
+    first = next(chunks, None)
+    second = next(chunks, None)
+    count_chunks(filter(None, chain([first, second], chunks)), counters,
+                 processes=processes if second is not None else 1)
+    for analysis, counter in zip(analyses, counters):
+        analysis.matrix = counter.matrix()
+
+
+def plan_category_domain_job(keywords, country_code):
+    """
+    Returns plans of the search volume and keyword rankings calls of category_domain_task
+    """
+    keywords = list(dict.fromkeys(keywords))
+    volume_plan = RequestPlan(keywords, 'v3/ResearchKeywordsGetListKeywordinfo', {'countrycode': 'us'})
+    info_plan = RequestPlan(keywords, 'v4/ResearchOrganicGetListRankingsKeyword',
+                            {'countrycode': country_code, 'limit': 25})
+    return volume_plan, info_plan
+
 
 @background(schedule=1)
 def category_domain_task(
         uploaded_file_url: str,
         key: str,
         secret: str,
-        country_code: str
+        country_code: str,
+        concurrency: int = None
 ) -> None:
     """
 
@@ -244,6 +337,15 @@ def category_domain_task(
 
     data = pd.read_csv(f'/{uploaded_file_url}')
 
+    volume_plan, info_plan = plan_category_domain_job(data['Keyword'], country_code)
+    logger.info(f"Category Domain Analysis have started. Search volume calls: {volume_plan.summary()}, "
+                f"rankings calls: {info_plan.summary()}")
+
+    keyword_volumes = {
+        result.item: result.value if result.ok else 0
+        for result in volume_plan.run(get_keyword_volume, concurrency=concurrency)
+    }
+
     category_dict = {}
     for keyword, integration in zip(data['Keyword'], data['SERP Feature Integrations']):
         words = keyword.replace('air jordan', '').split()
@@ -253,23 +355,23 @@ def category_domain_task(
             try:
                 numeric_value = int(word)
                 if len(word) == 4:
-                    add_to_dictionary(category_dict, 'year', keyword, integration)
+                    add_to_dictionary(category_dict, 'year', keyword, integration, keyword_volumes[keyword])
                     label_added = True
                 elif 'size' in words:
-                    add_to_dictionary(category_dict, 'size', keyword, integration)
+                    add_to_dictionary(category_dict, 'size', keyword, integration, keyword_volumes[keyword])
                     label_added = True
             except ValueError:
                 for category_name in CATEGORY_NAMES:
                     if word in CATEGORY_NAMES[category_name]:
-                        add_to_dictionary(category_dict, category_name, keyword, integration)
+                        add_to_dictionary(category_dict, category_name, keyword, integration, keyword_volumes[keyword])
                         label_added = True
 
         if re.findall(r'air jordan ([1-9]|[12]\d|3[0-3])', keyword):
-            add_to_dictionary(category_dict, 'air jordan', keyword, integration)
+            add_to_dictionary(category_dict, 'air jordan', keyword, integration, keyword_volumes[keyword])
             label_added = True
 
         if not label_added:
-            add_to_dictionary(category_dict, 'other', keyword, integration)
+            add_to_dictionary(category_dict, 'other', keyword, integration, keyword_volumes[keyword])
 
     domains = {}
     keywords_list, search_volumes, integrations = [], [], {}
@@ -279,16 +381,24 @@ def category_domain_task(
     filepath = f"{settings.REPORT_PATH}/{category_filename}"
     writer = pd.ExcelWriter(filepath, engine='xlsxwriter')
 
+    access_token = get_access_token(key, secret)
+    keywords_info = {
+        result.item: result.value if result.ok else (False, None)
+        for result in info_plan.run(
+            lambda keyword: get_keyword_info(
+                access_token=access_token,
+                keyword=keyword,
+                country_code=country_code
+            ),
+            concurrency=concurrency
+        )
+    }
+
     for category in category_dict:
         for index, keyword in enumerate(category_dict[category]['keywords']):
             keywords_list.append(keyword)
 
-            access_token = get_access_token(key, secret)
-            success, keywords_data = get_keyword_info(
-                access_token=access_token,
-                keyword=keyword,
-                country_code=country_code
-            )
+            success, keywords_data = keywords_info[keyword]
 
             if not success:
                 num_of_failed_keywords += 1
@@ -383,38 +493,56 @@ def run_domain_searchmetrics_simple(
         secret: str,
         amount: str,
         country_code: str,
-        domain: str
+        domain: str,
+        concurrency: int = None
 ) -> None:
     """
 
     """
     access_token = get_access_token(key, secret)
-
-    offset = 0
-    file_path = settings.REPORT_PATH + f'/simple_domain_sm_analysis_{generate_random_number()}.csv'
-    with open(file_path, "w+", encoding='utf-8', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(["Keyword", "URL", "Position", "Page", "Title", "Description", "Traffic", "Competition",
-                         "CPC", "Ad Budget", "Potential", "Avg Popularity", "Last Months Count"])
-
-        for _ in range(amount // 250):
-            data = get_rankings_data(domain, country_code, access_token, offset)
-
-            if data:
-                for element in data['response']:
+    countries = parse_country_codes(country_code)
+
+    columns = ["Keyword", "URL", "Position", "Page", "Title", "Description", "Traffic", "Competition",
+               "CPC", "Ad Budget", "Potential", "Avg Popularity", "Last Months Count"]
+
+    def fetch_country_rows(cc):
+        rows = []
+        for status, response in iter_pages(
+                lambda offset: get_rankings_page(domain, cc, access_token, offset),
+                amount=amount,
+                concurrency=concurrency
+        ):
+            if status:
+                for element in response:
                     try:
-                        writer.writerow([element['keyword'], element['url'], element['position'], element['page'],
-                                         element['title'], element['description'], element['traffic'],
-                                         element['competition'], element['cpc'], element['adbudget'], element['potential'],
-                                         element['avg_popularity'], element['last_months_count']])
+                        rows.append([element['keyword'], element['url'], element['position'], element['page'],
+                                     element['title'], element['description'], element['traffic'],
+                                     element['competition'], element['cpc'], element['adbudget'],
+                                     element['potential'], element['avg_popularity'], element['last_months_count']])
                     except Exception as e:
                         logger.info(f"Something went wrong while accessing response element. Error: {e}")
+        return rows
 
-            offset += 250
+    results = run_batch(fetch_country_rows, countries, concurrency=len(countries))
+
+    if len(countries) == 1:
+        file_path = settings.REPORT_PATH + f'/simple_domain_sm_analysis_{generate_random_number()}.csv'
+        with open(file_path, "w+", encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(results[0].value or [])
+    else:
+        file_path = settings.REPORT_PATH + f'/simple_domain_sm_analysis_{generate_random_number()}.xlsx'
+        writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+        for result in results:
+            if not result.ok:
+                logger.info(f"Searchmetrics rankings of {result.item} failed: {result.error}")
+            pd.DataFrame(result.value or [], columns=columns).to_excel(writer, sheet_name=result.item, index=False)
+        writer.save()
 
     subject = 'Domain Search Metrics Simple Analysis To CSV'
     message = f'Domain Search Metrics Analysis is Ready. Look at the attachment below.' \
-              f'\n\nParameters:\nDomain: {domain}\nCountry Code: {country_code}'
+              f'\n\nParameters:\nDomain: {domain}\nCountry Code: {", ".join(countries)}'
 
     from_email = settings.EMAIL_HOST_USER
     mail = EmailMessage(subject, message, from_email, settings.ADMIN_EMAILS)
@@ -432,83 +560,126 @@ def run_domain_searchmetrics_complete(
         secret: str,
         amount: str,
         country_code: str,
-        domain: str
+        domain: str,
+        concurrency: int = None
 ) -> None:
     """
 
     """
     access_token = get_access_token(key, secret)
+    countries = parse_country_codes(country_code)
 
-    keyword_info = {}
-    keywords = []
-    offset = 0
-    for _ in range(amount // 250):
-        data = get_rankings_data(domain, country_code, access_token, offset)
+    results = run_batch(
+        lambda cc: collect_domain_searchmetrics_country(domain, cc, amount, access_token, concurrency),
+        countries,
+        concurrency=len(countries)
+    )
 
-        if data:
-            for keyword in data['response']:
+    # Saved on the task thread, the connections of worker threads would never be closed
+    for result in results:
+        if not result.ok:
+            logger.info(f"Domain Search Metrics Analysis of {result.item} failed: {result.error}")
+            continue
+
+        try:
+            DomainData.objects.bulk_create(result.value, ignore_conflicts=True)
+        except DatabaseError as e:
+            # One bad row fails the whole insert, the others are saved one by one
+            logger.info(f"Error while saving Domain Data of {result.item} to database, saving it by rows: {e}")
+            for domain_data in result.value:
+                try:
+                    DomainData.objects.bulk_create([domain_data], ignore_conflicts=True)
+                except DatabaseError as e:
+                    logger.info(f"Error while saving Domain Data of {domain_data.keyword} to database: {e}")
+
+    subject = 'Domain Search Metrics Complete Analysis to DB'
+    message = f'Domain Search Metrics Analysis is Ready. You can find it at http://karlkleinschmidt.com' \
+              f'/admin/app/domaindata/?domain={domain}' \
+              f'\n\nParameters:\nDomain: {domain}\nCountry Code: {", ".join(countries)}'
+
+    from_email = settings.EMAIL_HOST_USER
+    mail = EmailMessage(subject, message, from_email, settings.ADMIN_EMAILS)
+
+    try:
+        mail.send(fail_silently=False)
+    except Exception as e:
+        logger.info(f"Something went wrong while sending an email. Error: {e}")
+
+
+def collect_domain_searchmetrics_country(domain, country_code, amount, access_token, concurrency=None):
+    """
+    Returns unsaved DomainData of the rankings of the domain in a single country, it does not
+    touch the database, so it can run in worker threads
+    """
+    keyword_traffic = {}
+    keywords = []
+    for status, response in iter_pages(
+            lambda offset: get_rankings_page(domain, country_code, access_token, offset),
+            amount=amount,
+            concurrency=concurrency
+    ):
+        if status:
+            for keyword in response:
                 try:
                     keywords.append(keyword['keyword'])
-                    keyword_info[keyword['keyword']] = keyword
+                    keyword_traffic[keyword['keyword']] = keyword.get('traffic')
                 except KeyError:
                     logger.info(f"Not found key in keywords data: {keyword}")
 
-        offset += 250
-
-    ranking = []
-    for index, keyword in enumerate(keywords):
-        keyword = keyword.strip()
-        api_url = 'http://api.searchmetrics.com/v3/ResearchOrganicGetListRankingsKeyword.json' \
-                  f'?keyword={keyword}&countrycode={country_code}&access_token={access_token}'
-        response = requests.get(api_url)
+    def fetch_keyword_data(keyword):
+        api_url = get_api_url('v3/ResearchOrganicGetListRankingsKeyword.json')
+        response = api_request(api_url, params={'keyword': keyword, 'countrycode': country_code,
+                                                'access_token': access_token})
 
         try:
-            ranking_info = response.json()['response']
+            ranking_info = decode(response.json()['response'], KeywordRanking)
         except Exception as e:
             logger.info(f"No response data found: {e}")
-            continue
+            return None
 
-        api_url = 'http://api.searchmetrics.com/v3/ResearchKeywordsGetListKeywordinfo.json' \
-                  f'?keyword={keyword}&countrycode={country_code}&access_token={access_token}'
-        response = requests.get(api_url)
+        api_url = get_api_url('v3/ResearchKeywordsGetListKeywordinfo.json')
+        response = api_request(api_url, params={'keyword': keyword, 'countrycode': country_code,
+                                                'access_token': access_token})
         data = response.json()
 
         keyword_data = None
         try:
-            for item in data['response']:
-                if item['keyword'] == keyword:
+            for item in decode(data['response'], KeywordInfo):
+                if item.keyword == keyword:
                     keyword_data = item
         except KeyError:
             logger.info("No response data found")
+            return None
+
+        return ranking_info, keyword_data
+
+    results = run_batch(
+        fetch_keyword_data,
+        [keyword.strip() for keyword in keywords],
+        concurrency=concurrency
+    )
+
+    rows = []
+    for result in results:
+        if not result.ok or result.value is None:
             continue
 
-        if len(ranking_info) == 0:
-            ranking.append(keyword)
+        keyword = result.item
+        ranking_info, keyword_data = result.value
 
         for info in ranking_info:
             try:
-                DomainData.objects.create(keyword=keyword, position=info['position'], url=info['url'],
-                                          title=info['title'],
-                                          traffic_index=int(keyword_info[keyword]['traffic']),
-                                          search_volume=int(keyword_data['search_volume']),
-                                          trend=info['trend']['trend'], cpc=keyword_data['cpc'],
-                                          integration=keyword_data['integration'],
-                                          competition=keyword_data['competition'], domain=domain)
+                rows.append(DomainData(keyword=keyword, position=info.position, url=info.url,
+                                       title=info.title,
+                                       traffic_index=int(keyword_traffic[keyword]),
+                                       search_volume=int(keyword_data.search_volume),
+                                       trend=info.trend, cpc=keyword_data.cpc,
+                                       integration=keyword_data.integration,
+                                       competition=keyword_data.competition, domain=domain,
+                                       country_code=country_code))
             except Exception as e:
-                logger.info(f"Error while saving Domain Data to database: {e}")
-
-    subject = 'Domain Search Metrics Complete Analysis to DB'
-    message = f'Domain Search Metrics Analysis is Ready. You can find it at http://karlkleinschmidt.com' \
-              f'/admin/app/domaindata/?domain={domain}' \
-              f'\n\nParameters:\nDomain: {domain}\nCountry Code: {country_code}'
-
-    from_email = settings.EMAIL_HOST_USER
-    mail = EmailMessage(subject, message, from_email, settings.ADMIN_EMAILS)
-
-    try:
-        mail.send(fail_silently=False)
-    except Exception as e:
-        logger.info(f"Something went wrong while sending an email. Error: {e}")
+                logger.info(f"Error while reading Domain Data of {keyword}: {e}")
+    return rows
 
 
 def get_example_url_keywords(
@@ -574,52 +745,107 @@ def get_example_url_keywords(
     return file_name
 
 
-@background(schedule=1)
-def search_volume_task(
-        uploaded_file_url,
-        country_code,
-        key,
-        secret
-):
-    df = pd.read_csv(f'/{uploaded_file_url}', encoding='unicode_escape')
+def plan_search_volume_job(keywords, country_code):
+    return RequestPlan(keywords, 'v3/ResearchKeywordsGetListKeywordinfo', {'countrycode': country_code})
 
-    keywords_data = [keyword for keyword in df['Keyword']]
 
-    logger.info('Search Volume Analysis have started')
+def collect_search_volumes(plan, country_code, access_token, concurrency=None):
+    """
+    Runs the search volume plan of a single country
 
+    Returns:
+        (keywords, search volumes, no data keywords, no data reasons, skipped keywords)
+    """
     keywords = []
     search_volumes = []
 
     no_data_keywords = []
     no_data_reason = []
+    skipped_keywords = []
 
-    access_token = get_access_token(key, secret)
-    for keyword in keywords_data:
-        response, keyword = get_keyword_data(keyword, country_code, access_token)
+    results = plan.run(
+        lambda keyword: get_keyword_data(keyword, country_code, access_token),
+        concurrency=concurrency
+    )
 
-        if 'error_message' in response.text:
-            access_token = get_access_token(key, secret)
-            response, keyword = get_keyword_data(keyword, country_code, access_token)
+    for result in results:
+        if isinstance(result.error, CircuitOpenError):
+            skipped_keywords.append(result.item)
+            continue
 
+        if not result.ok:
+            no_data_keywords.append(result.item)
+            no_data_reason.append("Request failed")
+            continue
+
+        response, keyword = result.value
         try:
             keyword_info = response.json()['response'][0]
             keywords.append(keyword)
             search_volumes.append(keyword_info['search_volume'])
-        except (KeyError, TypeError, JSONDecodeError) as e:
+        except (KeyError, IndexError, TypeError, JSONDecodeError) as e:
             logger.info(e)
             no_data_keywords.append(keyword)
             no_data_reason.append("No info returned")
 
+    return keywords, search_volumes, no_data_keywords, no_data_reason, skipped_keywords
+
+
+@background(schedule=1)
+def search_volume_task(
+        uploaded_file_url,
+        country_code,
+        key,
+        secret,
+        concurrency=None
+):
+    df = pd.read_csv(f'/{uploaded_file_url}', encoding='unicode_escape')
+
+    countries = parse_country_codes(country_code)
+    plans = {cc: plan_search_volume_job(df['Keyword'], cc) for cc in countries}
+
+    for cc, plan in plans.items():
+        logger.info(f'Search Volume Analysis of {cc} have started: {plan.summary()}')
+    api_calls = sum(plan.api_calls for plan in plans.values())
+    cached = sum(plan.cached for plan in plans.values())
+
+    access_token = get_access_token(key, secret)
+    results = run_batch(
+        lambda cc: collect_search_volumes(plans[cc], cc, access_token, concurrency),
+        countries,
+        concurrency=len(countries)
+    )
+
     file_name = f'search_volumes_{generate_random_number()}.xlsx'
     output = f'{settings.REPORT_PATH}/{file_name}'
     writer = pd.ExcelWriter(output, engine='xlsxwriter')
-    result_df = pd.DataFrame({'Keyword': keywords, 'Search Volume': search_volumes})
-    result_df.to_excel(writer, sheet_name='results', index=False)
-    error_df = pd.DataFrame({'Keyword': no_data_keywords, 'Error Reason': no_data_reason})
-    error_df.to_excel(writer, sheet_name='no-data', index=False)
+
+    skipped_count = 0
+    for result in results:
+        if not result.ok:
+            logger.info(f"Search Volume Analysis of {result.item} failed: {result.error}")
+            continue
+
+        suffix = f' {result.item}' if len(countries) > 1 else ''
+        keywords, search_volumes, no_data_keywords, no_data_reason, skipped_keywords = result.value
+
+        result_df = pd.DataFrame({'Keyword': keywords, 'Search Volume': search_volumes})
+        result_df.to_excel(writer, sheet_name=f'results{suffix}', index=False)
+        error_df = pd.DataFrame({'Keyword': no_data_keywords, 'Error Reason': no_data_reason})
+        error_df.to_excel(writer, sheet_name=f'no-data{suffix}', index=False)
+        if skipped_keywords:
+            skipped_df = pd.DataFrame({'Keyword': skipped_keywords})
+            skipped_df.to_excel(writer, sheet_name=f'skipped{suffix}', index=False)
+            skipped_count += len(skipped_keywords)
     writer.save()
 
-    send_mail('Search Volume Tool Analysis', 'Your Search Volume Analysis is ready to download.', output)
+    message = 'Your Search Volume Analysis is ready to download.'
+    message += f'\n\n{len(df)} keywords needed {api_calls} API calls, duplicates were looked up once ' \
+               f'and {cached} lookups were served from the cache.'
+    if skipped_count:
+        message += f'\n\n{skipped_count} keywords were skipped while the Searchmetrics API was failing. ' \
+                   f'Upload the "skipped" sheet as csv to retry them.'
+    send_mail('Search Volume Tool Analysis', message, output)
 
 
 def get_group_keywords(
@@ -635,40 +861,42 @@ def get_group_keywords(
     group_1_words = [word for word in group_1.split()]
     group_2_words = [word for word in group_2.split()]
 
-    with open(f"/{uploaded_file_url}", "r", encoding='utf-8') as f:
-        reader = list(csv.reader(f))
-
-    title_index = 0
-    for index, col_name in enumerate(reader[0]):
-        if col_name.lower() == 'title':
-            title_index = index
+    both_groups_matcher = SubstringMatcher(group_1_words + group_2_words)
+    group_1_matcher = SubstringMatcher(group_1_words)
+    group_2_matcher = SubstringMatcher(group_2_words)
 
+    # Titles are counted while streaming the file, only the counters of each keyword are kept.
+    # Keywords including a group word are kept as None to count them as unique keywords only
     words_dict = {}
-    for row in reader[1:]:
-        if row[0] not in words_dict.keys():
-            words_dict[row[0]] = [row[title_index]]
-        else:
-            words_dict[row[0]].append(row[title_index])
+    with open(f"/{uploaded_file_url}", "r", encoding='utf-8') as f:
+        reader = csv.reader(f)
 
-    result_words_dict = {}
-    for key in words_dict.keys():
-        if not is_included(key, group_1_words + group_2_words):
-            result_words_dict[key] = words_dict[key]
+        title_index = 0
+        for index, col_name in enumerate(next(reader, [])):
+            if col_name.lower() == 'title':
+                title_index = index
 
-    group_1_or_2, group_1, group_2 = [], [], []
+        for row in reader:
+            if row[0] not in words_dict:
+                words_dict[row[0]] = None if is_included(row[0], both_groups_matcher) else [0, 0, 0]
 
-    for key in result_words_dict:
-        both_group_cnt, first_group_cnt, second_group_cnt = 0, 0, 0
+            counters = words_dict[row[0]]
+            if counters is None:
+                continue
 
-        for title in result_words_dict[key]:
+            title = row[title_index]
+            if is_included(title, both_groups_matcher):
+                counters[0] += 1
+            if is_included(title, group_1_matcher):
+                counters[1] += 1
+            if is_included(title, group_2_matcher):
+                counters[2] += 1
 
-            if is_included(title, group_1_words + group_2_words):
-                both_group_cnt += 1
-            if is_included(title, group_1_words):
-                first_group_cnt += 1
-            if is_included(title, group_2_words):
-                second_group_cnt += 1
+    result_words_dict = {key: counters for key, counters in words_dict.items() if counters is not None}
 
+    group_1_or_2, group_1, group_2 = [], [], []
+
+    for key, (both_group_cnt, first_group_cnt, second_group_cnt) in result_words_dict.items():
         if both_group_cnt > 4:
             group_1_or_2.append(key)
         if first_group_cnt > 4:
@@ -703,30 +931,41 @@ def get_group_keywords(
 def get_keyword_domain(
         data,
         access_token,
-        country_code
+        country_code,
+        concurrency=None
 ) -> str:
     keywords = []
     for item in data:
         keywords.append(item)
 
+    results = run_batch(
+        lambda element: get_keyword_info(
+            access_token=access_token,
+            keyword=element['keyword'],
+            country_code=country_code
+        ),
+        keywords,
+        concurrency=concurrency
+    )
+
     domains = {}
     keywords_list, search_volumes, integrations = [], [], {}
+    skipped_keywords = []
     num_of_failed_keywords = 0
-    for index, element in enumerate(keywords):
+    for element, result in zip(keywords, results):
         keyword = element['keyword']
 
         keywords_list.append(keyword)
         search_volumes.append(int(element['search_volume']))
 
-        success, keywords_data = get_keyword_info(
-            access_token=access_token,
-            keyword=keyword,
-            country_code=country_code
-        )
+        success, keywords_data = result.value if result.ok else (False, None)
 
         if not success:
             num_of_failed_keywords += 1
 
+        if isinstance(result.error, CircuitOpenError):
+            skipped_keywords.append(element)
+
         for integration in element['integration'].split(','):
             if integration in integrations:
                 integrations[integration] += 1
@@ -816,6 +1055,17 @@ def get_keyword_domain(
         )
         df.to_excel(writer, sheet_name=str(domain)[:30], index=False)
 
+    if skipped_keywords:
+        df = pd.DataFrame(
+            {
+                'Keyword': [element['keyword'] for element in skipped_keywords],
+                'Search Volume': [element['search_volume'] for element in skipped_keywords],
+                'CPC': [element['cpc'] for element in skipped_keywords],
+                'Integration': [element['integration'] for element in skipped_keywords],
+            }
+        )
+        df.to_excel(writer, sheet_name='skipped', index=False)
+
     writer.save()
 
     return filename
@@ -828,33 +1078,47 @@ def get_similar_keywords(
         sort_label: str
 ) -> str:
     words_dict = {}
+    last_rows = {}
 
     with open(uploaded_file_url, "r") as f:
-        reader = list(csv.reader(f))
-
-    line_num = 0
-    row_num = 0
-
-    for row in reader:
-        if line_num == 0:
-            for index, column in enumerate(row):
-                if column == sort_type:
-                    row_num = index
-                    break
-            line_num += 1
-            continue
+        reader = csv.reader(f)
+
+        row_num = 0
+        for index, column in enumerate(next(reader, [])):
+            if column == sort_type:
+                row_num = index
+                break
+
+        for line_num, row in enumerate(reader):
+            phrase = row[0]
+            index = int(row[row_num])
+
+            if index >= limit:
+                words_dict[phrase] = {phrase: index}
+                last_rows[phrase] = line_num
+
+    # The second pass streams the file again and adds every other row containing all words
+    # of a phrase, the phrases are looked up by their first word
+    phrases_by_word = {}
+    match_all = []
+    for phrase in words_dict:
+        words = phrase.split()
+        if words:
+            phrases_by_word.setdefault(words[0], []).append((phrase, words))
+        else:
+            match_all.append((phrase, words))
 
-        phrase = row[0]
-        words = row[0].split()
-        index = int(row[row_num])
+    with open(uploaded_file_url, "r") as f:
+        reader = csv.reader(f)
+        next(reader, None)
 
-        if index >= limit:
-            words_dict[phrase] = {phrase: index}
+        for line_num, row in enumerate(reader):
+            row_words = set(row[0].split())
+            candidates = match_all + [candidate for word in row_words for candidate in phrases_by_word.get(word, ())]
 
-            for row1 in reader:
-                if row is not row1:
-                    if all(elem in row1[0].split() for elem in words):
-                        words_dict[phrase][row1[0]] = int(row1[row_num])
+            for phrase, words in candidates:
+                if line_num != last_rows[phrase] and all(elem in row_words for elem in words):
+                    words_dict[phrase][row[0]] = int(row[row_num])
 
     sorted_words = {}
     for word in words_dict.keys():
@@ -1070,39 +1334,32 @@ def get_url_searchmetrics(
         amount: int,
         domain: str,
         key: str,
-        secret: str
+        secret: str,
+        concurrency: int = None
 ) -> (bool, str):
     date_from = datetime.strftime(datetime.strptime(date_from, '%Y-%m-%d'), '%Y%m%d')
     date_to = datetime.strftime(datetime.strptime(date_to, '%Y-%m-%d'), '%Y%m%d')
 
     access_token = get_access_token(key, secret)
 
-    offset = 0
     before_data, after_data = [], []
-    n_requests = int(amount / 250)
-    for _ in range(n_requests):
-        from_date_info = get_list_rankings(access_token, domain, date_from, offset)
-        after_date_info = get_list_rankings(access_token, domain, date_to, offset)
-
-        if from_date_info[0]:
-            before_data += from_date_info[1]
-        else:
-            error_message = 'API Error: ' + from_date_info[1]
-            return False, error_message
-
-        if after_date_info[0]:
-            after_data += after_date_info[1]
-        else:
-            error_message = 'API Error: ' + after_date_info[1]
-            return False, error_message
-
-        offset += 250
+    for date, data in ((date_from, before_data), (date_to, after_data)):
+        for status, response in iter_pages(
+                lambda offset, date=date: get_list_rankings(access_token, domain, date, offset),
+                amount=amount,
+                concurrency=concurrency
+        ):
+            if not status:
+                error_message = f'API Error: {response}'
+                return False, error_message
+
+            data += decode(response, HistoricRanking)
 
     words_dict = {}
     for first in before_data:
         exists = False
 
-        full_url = f'https://{first["url"]}' if not urlparse.urlparse(first['url']).scheme else first['url']
+        full_url = f'https://{first.url}' if not urlparse.urlparse(first.url).scheme else first.url
         directories = generate_directories(full_url)
         subdomain = get_subdomain(full_url)
         if subdomain and subdomain != 'www':
@@ -1137,53 +1394,53 @@ def get_url_searchmetrics(
                 words_dict[diry]['type'] = dir_type
 
             for second in after_data:
-                if first['url'] == second['url'] and first['keyword'] == second['keyword']:
-                    rank_change = first['position'] - second['position']
-                    traffic_change = second['traffic_monthly'] - first['traffic_monthly']
+                if first.url == second.url and first.keyword == second.keyword:
+                    rank_change = first.position - second.position
+                    traffic_change = second.traffic_monthly - first.traffic_monthly
                     if rank_change >= 0:
-                        words_dict[diry]['winners'][first['keyword']] = {'url': first['url'],
-                                                                         'traffic': first['traffic_monthly'],
-                                                                         'position_trend': rank_change,
-                                                                         'position': first['position'],
-                                                                         'search_volume':
-                                                                             first['search_volume_monthly'],
-                                                                         'type': '',
-                                                                         'traffic_change': traffic_change}
+                        words_dict[diry]['winners'][first.keyword] = {'url': first.url,
+                                                                      'traffic': first.traffic_monthly,
+                                                                      'position_trend': rank_change,
+                                                                      'position': first.position,
+                                                                      'search_volume':
+                                                                          first.search_volume_monthly,
+                                                                      'type': '',
+                                                                      'traffic_change': traffic_change}
                     else:
-                        words_dict[diry]['losers'][first['keyword']] = {'url': first['url'],
-                                                                        'traffic': first['traffic_monthly'],
-                                                                        'position_trend': rank_change,
-                                                                        'position': first['position'],
-                                                                        'search_volume':
-                                                                            first['search_volume_monthly'],
-                                                                        'type': '',
-                                                                        'traffic_change': traffic_change}
+                        words_dict[diry]['losers'][first.keyword] = {'url': first.url,
+                                                                     'traffic': first.traffic_monthly,
+                                                                     'position_trend': rank_change,
+                                                                     'position': first.position,
+                                                                     'search_volume':
+                                                                         first.search_volume_monthly,
+                                                                     'type': '',
+                                                                     'traffic_change': traffic_change}
                     if 'search_volume' in words_dict[diry].keys():
-                        words_dict[diry]['search_volume'] += first['search_volume_monthly']
+                        words_dict[diry]['search_volume'] += first.search_volume_monthly
                     else:
-                        words_dict[diry]['search_volume'] = first['search_volume_monthly']
+                        words_dict[diry]['search_volume'] = first.search_volume_monthly
 
                     exists = True
 
             if not exists:
-                traffic_change = -1 * first['traffic_monthly']
+                traffic_change = -1 * first.traffic_monthly
                 if 'search_volume' in words_dict[diry].keys():
-                    words_dict[diry]['search_volume'] += first['search_volume_monthly']
+                    words_dict[diry]['search_volume'] += first.search_volume_monthly
                 else:
-                    words_dict[diry]['search_volume'] = first['search_volume_monthly']
+                    words_dict[diry]['search_volume'] = first.search_volume_monthly
 
-                words_dict[diry]['out'][first['keyword']] = {'url': first['url'],
-                                                             'traffic': first['traffic_monthly'],
-                                                             'position': first['position'],
-                                                             'position_trend': -1 * first['position'],
-                                                             'search_volume':
-                                                                 first['search_volume_monthly'],
-                                                             'type': 'out',
-                                                             'traffic_change': traffic_change}
+                words_dict[diry]['out'][first.keyword] = {'url': first.url,
+                                                          'traffic': first.traffic_monthly,
+                                                          'position': first.position,
+                                                          'position_trend': -1 * first.position,
+                                                          'search_volume':
+                                                              first.search_volume_monthly,
+                                                          'type': 'out',
+                                                          'traffic_change': traffic_change}
 
     for second in after_data:
         exists = False
-        full_url = f'https://{second["url"]}' if not urlparse.urlparse(second['url']).scheme else second['url']
+        full_url = f'https://{second.url}' if not urlparse.urlparse(second.url).scheme else second.url
         directories = generate_directories(full_url)
         subdomain = get_subdomain(full_url)
         if subdomain and subdomain != 'www':
@@ -1218,23 +1475,23 @@ def get_url_searchmetrics(
                 words_dict[diry]['type'] = dir_type
 
             for first in before_data:
-                if second['url'] == first['url'] and second['keyword'] == first['keyword']:
+                if second.url == first.url and second.keyword == first.keyword:
                     exists = True
 
             if not exists:
-                traffic_change = second['traffic_monthly']
-                words_dict[diry]['new'][second['keyword']] = {'url': second['url'],
-                                                              'traffic': second['traffic_monthly'],
-                                                              'position': second['position'],
-                                                              'position_trend': second['position'],
-                                                              'search_volume':
-                                                                  second['search_volume_monthly'],
-                                                              'type': 'new',
-                                                              'traffic_change': traffic_change}
+                traffic_change = second.traffic_monthly
+                words_dict[diry]['new'][second.keyword] = {'url': second.url,
+                                                           'traffic': second.traffic_monthly,
+                                                           'position': second.position,
+                                                           'position_trend': second.position,
+                                                           'search_volume':
+                                                               second.search_volume_monthly,
+                                                           'type': 'new',
+                                                           'traffic_change': traffic_change}
                 if 'search_volume' in words_dict[diry].keys():
-                    words_dict[diry]['search_volume'] += second['search_volume_monthly']
+                    words_dict[diry]['search_volume'] += second.search_volume_monthly
                 else:
-                    words_dict[diry]['search_volume'] = second['search_volume_monthly']
+                    words_dict[diry]['search_volume'] = second.search_volume_monthly
 
     file_name = f'winners_and_losers_{domain}_from_{date_from}_to_{date_to}.xlsx'
     output = f'{settings.REPORT_PATH}/{file_name}'
@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+
+from keywords.cooccurrence import tokenize
+
+
+class ItemsetMiner:
+    """
+    Apriori mining of the sets of words found together in keywords. The support of a set is
+    the summed weight of the keywords containing all of its words, repeated words of a keyword
+    count once. Every size takes one pass over the keywords: words not part of any frequent set
+    of the previous size are dropped from the keywords first, then the sets of a keyword are grown
+    a word at a time and dropped as soon as they are not frequent. The work follows the frequent
+    sets found in the keywords instead of all combinations of their words.
+    Negative weights count as 0, otherwise supersets of an infrequent set could become frequent.
+
+    Attributes:
+        min_support (number): sets reaching it are frequent, only sets seen in a keyword are counted
+        is_word (callable): predicate of the tokens counted as words, called once per distinct token
+        words (list): vocabulary of the counted keywords in the order of the first occurrence
+        frequent (list): frequent sets of every size as Series of their support indexed by word ids
+    """
+    def __init__(self, min_support, is_word=None):
+        self.min_support = min_support
+        self.is_word = is_word
+        self.words = []
+        self.frequent = []
+
+        self._index = {}
+        self._qualified = {}
+
+    def _is_word(self, token):
+        qualified = self._qualified.get(token)
+        if qualified is None:
+            qualified = self._qualified[token] = bool(self.is_word(token))
+        return qualified
+
+    def _transactions(self, keywords, weights, selected, items):
+        """
+        Returns sorted distinct word ids of the selected keywords with their clipped weights,
+        only ids of items are kept, new words are added to the vocabulary if items is None
+        """
+        tokens = tokenize(keywords, self._is_word if self.is_word is not None else None)
+        if weights is None:
+            weights = np.ones(tokens.size, dtype=np.int64)
+        weights = np.maximum(np.asarray(weights), 0)
+
+        kept = np.ones(len(tokens.rows), dtype=bool)
+        if selected is not None:
+            kept &= np.asarray(selected, dtype=bool)[tokens.rows]
+        if items is None:
+            for word_id in pd.unique(tokens.word_ids[kept]):
+                word = tokens.words[word_id]
+                if word not in self._index:
+                    self._index[word] = len(self.words)
+                    self.words.append(word)
+        ids = np.array([self._index.get(word, -1) for word in tokens.words], dtype=np.int64)[tokens.word_ids]
+        if items is not None:
+            kept &= (ids >= 0) & items[np.maximum(ids, 0)]
+
+        frame = pd.DataFrame({'row': tokens.rows[kept], 'item': ids[kept]}).drop_duplicates()
+        frame = frame.sort_values(['row', 'item'], kind='stable')
+        return frame['row'].to_numpy(), frame['item'].to_numpy(), weights
+
+    def _count(self, rows, items, weights, size):
+        """
+        Returns summed weights of the candidate sets of size found in the transactions. The sets
+        of a transaction are grown by one of its later items at a time and dropped as soon as they
+        are not frequent, the sets of size are only kept if all of their subsets are frequent.
+        """
+        if not len(rows):
+            return None
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        ends = np.repeat(np.r_[starts[1:], len(rows)], np.diff(np.r_[starts, len(rows)]))
+
+        # Sets are kept with the position of their last item in the transactions
+        last = np.arange(len(rows))
+        sets = items[:, None]
+        for grown in range(2, size + 1):
+            counts = ends[last] - last - 1
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            last = np.repeat(last, counts) + 1 + offsets
+            sets = np.column_stack([np.repeat(sets, counts, axis=0), items[last]])
+
+            if grown < size:
+                candidate = pd.MultiIndex.from_arrays(list(sets.T)).isin(self.frequent[grown - 1].index)
+            else:
+                # Apriori pruning, a set can only be frequent if all of its subsets are, the subset
+                # without the last item is frequent already and single items are frequent words
+                candidate = np.ones(len(sets), dtype=bool)
+                for dropped in range(size - 1 if size > 2 else 0):
+                    subsets = np.delete(sets, dropped, axis=1)
+                    candidate &= pd.MultiIndex.from_arrays(list(subsets.T)).isin(self.frequent[size - 2].index)
+            last, sets = last[candidate], sets[candidate]
+            if not len(sets):
+                return None
+
+        support = weights[rows[last]]
+        if size == 1:
+            index = pd.Index(sets[:, 0])
+        else:
+            index = pd.MultiIndex.from_arrays(list(sets.T))
+        return pd.Series(support, index=index).groupby(level=list(range(size)), sort=False).sum()
+
+    def mine(self, read_chunks, max_size):
+        """
+        Args:
+            read_chunks (callable): returns a new iterator of (keywords, weights, selected) chunks,
+                weights and selected mask of the keywords are None to count all keywords once
+            max_size (int): largest size of the sets
+        """
+        items = None
+        for size in range(1, max_size + 1):
+            totals = None
+            for keywords, weights, selected in read_chunks():
+                rows, chunk_items, weights = self._transactions(keywords, weights, selected, items)
+                counted = self._count(rows, chunk_items, weights, size)
+                if counted is None:
+                    continue
+                totals = counted if totals is None else \
+                    pd.concat([totals, counted]).groupby(level=list(range(size)), sort=False).sum()
+
+            if totals is None or not (totals >= self.min_support).any():
+                break
+            frequent = totals[totals >= self.min_support]
+            self.frequent.append(frequent)
+
+            items = np.zeros(len(self.words), dtype=bool)
+            items[np.unique(np.asarray(frequent.index.tolist()).ravel())] = True
+        return self
+
+    def itemsets(self, min_size=1, top_n=None):
+        """
+        Returns ('first second ...', support) of the frequent sets of at least min_size words
+        ordered by support, sets of equal support by size and then by their first occurrence.
+        With top_n only the top_n highest sets are returned.
+        """
+        itemsets = []
+        for frequent in self.frequent[min_size - 1:]:
+            for ids, support in frequent.items():
+                ids = ids if isinstance(ids, tuple) else (ids,)
+                itemsets.append((' '.join(self.words[word_id] for word_id in sorted(ids)), support))
+        itemsets.sort(key=lambda itemset: itemset[1], reverse=True)
+        return itemsets[:top_n]
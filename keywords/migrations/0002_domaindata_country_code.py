@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keywords', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='domaindata',
+            name='country_code',
+            field=models.CharField(blank=True, default='', max_length=3),
+        ),
+        migrations.AlterUniqueTogether(
+            name='domaindata',
+            unique_together={('domain', 'keyword', 'url', 'country_code')},
+        ),
+    ]
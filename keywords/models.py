@@ -26,10 +26,15 @@ class DomainData(models.Model):
     )
     cpc = models.FloatField(default=0.0)
     competition = models.FloatField(default=0.0)
+    country_code = models.CharField(
+        max_length=3,
+        default='',
+        blank=True
+    )
 
     class Meta:
         verbose_name = 'Domain Data Keyword'
-        unique_together = ('domain', 'keyword', 'url')
+        unique_together = ('domain', 'keyword', 'url', 'country_code')
 
     def __str__(self):
         return self.keyword
@@ -1,3 +1,108 @@
 from django.test import TestCase
+import numpy as np
 
-# Create your tests here.
+from core.matcher import SubstringMatcher
+
+from .cooccurrence import CooccurrenceCounter, CooccurrenceMatrix, WordFilter, count_chunks, inverted_index, lookup
+from .itemsets import ItemsetMiner
+
+
+class CooccurrenceMatrixTest(TestCase):
+    def setUp(self):
+        self.matrix = CooccurrenceMatrix.from_keywords(
+            ['red shoe', 'shoe shoe nike', 'a a red', 'blue'],
+            weights=[2, 3, 5, 0],
+            is_word=lambda word: word != 'blue'
+        )
+
+    def test_words_keep_first_occurrence_order(self):
+        self.assertEquals(self.matrix.words, ['red', 'shoe', 'nike', 'a'])
+
+    def test_pairs_are_weighted_by_occurrences(self):
+        values = dict(self.matrix.pairs(self.matrix.words, 0))
+        self.assertEquals(values, {'red shoe': 2, 'red a': 10, 'shoe nike': 6})
+        self.assertEquals(list(self.matrix.diagonal()), [7, 14, 3, 10])
+
+    def test_pairs_never_seen_together_are_missing(self):
+        rows = list(self.matrix.rows(['nike', 'red']))
+        self.assertEquals(rows, [[3, None], [None, 7]])
+
+    def test_chunks_add_up_to_single_pass(self):
+        counter = CooccurrenceCounter(is_word=lambda word: word != 'blue')
+        counter.add(['red shoe', 'shoe shoe nike'], weights=[2, 3])
+        counter.add(['a a red', 'blue'], weights=[5, 0])
+        matrix = counter.matrix()
+
+        self.assertEquals(matrix.words, self.matrix.words)
+        self.assertEquals(matrix.pairs(matrix.words, 0), self.matrix.pairs(self.matrix.words, 0))
+        self.assertEquals(list(matrix.diagonal()), list(self.matrix.diagonal()))
+
+    def test_shards_counted_in_processes_match_chunks(self):
+        chunks = [(['red shoe', 'shoe shoe nike'], [2, 3]), (['a a red', 'blue'], [5, 0]), (['nike air'], [1])]
+        is_word = WordFilter(SubstringMatcher(['blu']))
+
+        counter = CooccurrenceCounter(is_word=is_word)
+        for keywords, weights in chunks:
+            counter.add(keywords, weights)
+        sharded = CooccurrenceCounter(is_word=is_word)
+        sharded.add_shards(chunks, processes=2)
+
+        matrix, sharded_matrix = counter.matrix(), sharded.matrix()
+        self.assertEquals(sharded_matrix.words, matrix.words)
+        self.assertEquals(sharded_matrix.pairs(matrix.words, 0), matrix.pairs(matrix.words, 0))
+        self.assertEquals(list(sharded_matrix.diagonal()), list(matrix.diagonal()))
+
+    def test_weightings_of_one_tokenization_match_separate_counts(self):
+        keywords = ['red shoe', 'shoe shoe nike', 'a a red', 'blue']
+        weights = np.array([2, 3, 5, 0])
+        selected = weights >= 3
+        chunks = [(keywords[:2], [(None, None), (weights[:2], selected[:2])]),
+                  (keywords[2:], [(None, None), (weights[2:], selected[2:])])]
+
+        counters = [CooccurrenceCounter(), CooccurrenceCounter()]
+        count_chunks(chunks, counters)
+        expected = [CooccurrenceMatrix.from_keywords(keywords),
+                    CooccurrenceMatrix.from_keywords(['shoe shoe nike', 'a a red'], [3, 5])]
+
+        for counter, matrix in zip(counters, expected):
+            counted = counter.matrix()
+            self.assertEquals(counted.words, matrix.words)
+            self.assertEquals(counted.pairs(matrix.words, 0), matrix.pairs(matrix.words, 0))
+            self.assertEquals(list(counted.diagonal()), list(matrix.diagonal()))
+
+    def test_top_n_pairs_are_the_head_of_all_pairs(self):
+        pairs = sorted(self.matrix.pairs(self.matrix.words, 0), key=lambda pair: pair[1], reverse=True)
+        self.assertEquals(self.matrix.pairs(self.matrix.words, 0, top_n=2), pairs[:2])
+        self.assertEquals(self.matrix.pairs(self.matrix.words, 0, top_n=2), [('red a', 10), ('shoe nike', 6)])
+
+    def test_frame_keeps_pairs_with_zero_value(self):
+        matrix = CooccurrenceMatrix.from_keywords(['red shoe', 'nike red'], weights=[0, 4])
+        frame = matrix.to_frame(['nike', 'shoe'])
+        self.assertEquals(list(frame['Word 1']), ['nike', 'shoe'])
+        self.assertEquals(list(frame['Value']), [4, 0])
+
+
+class InvertedIndexTest(TestCase):
+    def test_keywords_containing_all_words_are_found(self):
+        index = inverted_index(['red shoe', 'nike shoe red', 'shoe', 'red red shoe'], words=['red', 'shoe'])
+        self.assertEquals(list(lookup(index, ['shoe', 'red'])), [0, 1, 3])
+        self.assertEquals(list(lookup(index, ['red', 'nike'])), [])
+
+
+class ItemsetMinerTest(TestCase):
+    def setUp(self):
+        keywords = ['red nike air shoe', 'nike air red', 'blue nike air shoe red', 'nike shoe']
+        self.miner = ItemsetMiner(2).mine(lambda: iter([(keywords, [1, 2, 3, 4], None)]), 4)
+
+    def test_support_sums_weights_of_keywords_containing_all_words(self):
+        itemsets = dict(self.miner.itemsets())
+        self.assertEquals(itemsets['nike shoe'], 8)
+        self.assertEquals(itemsets['red nike air'], 6)
+        self.assertEquals(itemsets['red nike air shoe'], 4)
+        self.assertEquals(itemsets['blue'], 3)
+
+    def test_sets_below_min_support_are_pruned(self):
+        miner = ItemsetMiner(5).mine(lambda: iter([(['red nike air shoe', 'nike air red', 'blue nike air shoe red',
+                                                     'nike shoe'], [1, 2, 3, 4], None)]), 4)
+        self.assertEquals(miner.itemsets(min_size=3), [('red nike air', 6)])
+        self.assertEquals(len(miner.frequent), 3)
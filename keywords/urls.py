@@ -19,6 +19,7 @@ urlpatterns = [
     path('api/v1/getWordCount', api_views.WordsCountAPI.as_view(), name='WordsCountAPI'),
     path('api/v1/getTrafficCount', api_views.TrafficCountAPI.as_view(), name='TrafficCountAPI'),
     path('api/v1/getSearchCount', api_views.SearchCountAPI.as_view(), name='SearchCountAPI'),
+    path('api/v1/getCombinedCount', api_views.CombinedCountAPI.as_view(), name='CombinedCountAPI'),
     path('api/v1/getSearchMetrics', api_views.SearchMetricsAPI.as_view(), name='SearchMetricsAPI'),
     path('api/v1/getExampleKeywords', api_views.ExampleKeywordsAPI.as_view(), name='ExampleKeywordsAPI'),
     path('api/v1/getSimilarKeywords', api_views.SimilarKeywordsAPI.as_view(), name='SimilarKeywordsAPI'),